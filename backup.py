@@ -0,0 +1,202 @@
+# coding: utf-8
+'''
+加工プログラムのバックアップアーカイブ
+
+プログラムの中身はハッシュ値をキーにして圧縮保存し、全ホストで共有する。
+ホストごと・スナップショットごとに、パスとハッシュ値の対応をマニフェストとして保存する。
+
+フォルダ構成:
+    <root>/objects/<ハッシュ値の先頭2文字>/<ハッシュ値> : 圧縮したプログラム
+    <root>/manifests/<ホスト>/<スナップショット名>.json : マニフェスト
+'''
+import hashlib
+import json
+import lzma
+import os
+import time
+import zlib
+
+from ncprog import normalize_name
+from util import write_atomic
+
+
+_COMPRESSORS = {
+    'lzma': (lzma.compress, lzma.decompress),
+    'zlib': (lambda data: zlib.compress(data, 9), zlib.decompress),
+}
+
+
+class ProgramArchive:
+    '''加工プログラムを重複排除して保存するアーカイブ。'''
+
+    def __init__(self, root, compression='lzma'):
+        '''
+        Args:
+            root (str): アーカイブのフォルダ
+            compression (str): 新しく保存するプログラムの圧縮形式 'lzma' or 'zlib'
+        '''
+        if compression not in _COMPRESSORS:
+            raise Exception('圧縮形式は、lzma or zlibのどちらかを設定して下さい。')
+        self.__root = root
+        self.__compression = compression
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'manifests'), exist_ok=True)
+
+    # --- プログラム本体の保存 ---
+
+    def put(self, data):
+        '''プログラムを保存し、ハッシュ値を返す。同じ内容が保存済みなら何もしない。
+
+        Args:
+            data (bytes): プログラムの中身
+        Return:
+            str: ハッシュ値(sha256)
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self.__object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            compress = _COMPRESSORS[self.__compression][0]
+            # 圧縮形式を先頭1行に記録し、読み込み時はそれに従って展開する
+            write_atomic(object_path, self.__compression.encode('ascii') + b'\n' + compress(data))
+        return digest
+
+    def get(self, digest):
+        '''ハッシュ値からプログラムを取り出す。
+
+        Args:
+            digest (str): ハッシュ値
+        Return:
+            bytes: プログラムの中身
+        '''
+        with open(self.__object_path(digest), 'rb') as f:
+            compression, _, body = f.read().partition(b'\n')
+        data = _COMPRESSORS[compression.decode('ascii')][1](body)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise Exception('アーカイブ内のプログラムが壊れています。(hash: ' + digest + ')')
+        return data
+
+    def has(self, digest):
+        '''ハッシュ値のプログラムが保存済みならTrue'''
+        return os.path.exists(self.__object_path(digest))
+
+    # --- マニフェスト ---
+
+    def snapshots(self, host):
+        '''ホストのスナップショット名を古い順に返す。
+
+        Args:
+            host: IPアドレス:ポート番号
+        Return:
+            list: スナップショット名のリスト
+        '''
+        host_dir = self.__host_dir(host)
+        if not os.path.isdir(host_dir):
+            return []
+        return sorted(name[:-5] for name in os.listdir(host_dir) if name.endswith('.json'))
+
+    def manifest(self, host, snapshot=None):
+        '''スナップショットのマニフェストを返す。
+
+        Args:
+            host: IPアドレス:ポート番号
+            snapshot (str): スナップショット名。Noneなら最新
+        Return:
+            dict: 絶対パス -> {'hash', 'size', 'date', 'comment'}。スナップショットが無ければ空のdict
+        '''
+        if snapshot is None:
+            snapshots = self.snapshots(host)
+            if not snapshots:
+                return {}
+            snapshot = snapshots[-1]
+        with open(os.path.join(self.__host_dir(host), snapshot + '.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)['programs']
+
+    # --- バックアップとリストア ---
+
+    def backup(self, j3, host, folders=('//CNC_MEM/USER/LIBRARY/',), snapshot=None):
+        '''NC内のプログラムをバックアップし、スナップショットを作成する。
+
+        find_dir()のサイズ・更新日時・コメントが前回のスナップショットと同じプログラムは、
+        読み込まずに前回のハッシュ値を引き継ぐ。
+
+        Args:
+            j3 (J3): バックアップ元の接続
+            host: IPアドレス:ポート番号（マニフェストの保存先に使う）
+            folders (list): バックアップするフォルダ。サブフォルダも対象にする。
+            snapshot (str): スナップショット名。Noneなら現在日時
+        Return:
+            dict: {'snapshot': スナップショット名, 'total': 本数, 'read': 読み込んだ本数, 'stored': 新しく保存した本数}
+        '''
+        snapshot = snapshot or time.strftime('%Y%m%d-%H%M%S')
+        previous = self.manifest(host)
+
+        # NC内の一覧を取得し、変化の無いものは前回のハッシュ値を使う
+        programs = {}
+        changed = []
+        for path, info in ProgramArchive.__walk(j3, folders):
+            entry = {'size': info['size'], 'date': info.get('date', ''), 'comment': info['comment']}
+            old = previous.get(path)
+            if old is not None and all(old.get(key) == value for key, value in entry.items()) and self.has(old['hash']):
+                entry['hash'] = old['hash']
+            else:
+                changed.append(path)
+            programs[path] = entry
+
+        stored = 0
+        if changed:
+            for path, data in j3.read_files(changed).items():
+                digest = hashlib.sha256(data).hexdigest()
+                if not self.has(digest):
+                    stored += 1
+                programs[path]['hash'] = self.put(data)
+
+        manifest = {'host': host, 'snapshot': snapshot, 'created': time.time(), 'programs': programs}
+        os.makedirs(self.__host_dir(host), exist_ok=True)
+        write_atomic(
+            os.path.join(self.__host_dir(host), snapshot + '.json'),
+            json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8'))
+        return {'snapshot': snapshot, 'total': len(programs), 'read': len(changed), 'stored': stored}
+
+    def restore(self, j3, host, snapshot=None, paths=None):
+        '''スナップショットのプログラムをNCに書き込む。
+
+        プログラムは1本ずつ展開してwrite_file()で書き込む。
+
+        Args:
+            j3 (J3): 書き込み先の接続
+            host: IPアドレス:ポート番号（マニフェストの取得に使う）
+            snapshot (str): スナップショット名。Noneなら最新
+            paths (list): 書き込む絶対パスのリスト。Noneなら全て
+        Return:
+            list: 書き込んだ絶対パスのリスト
+        '''
+        programs = self.manifest(host, snapshot)
+        if not programs:
+            raise Exception('リストアするスナップショットがありません。(host: ' + host + ')')
+        if paths is None:
+            paths = sorted(programs)
+        for path in paths:
+            if path not in programs:
+                raise Exception('スナップショットに存在しないプログラムです。(path: ' + path + ')')
+        for path in paths:
+            j3.write_file(path, self.get(programs[path]['hash']))
+        return list(paths)
+
+    @staticmethod
+    def __walk(j3, folders):
+        '''フォルダを再帰的に検索し、(絶対パス, find_dir()の1件)を返す。プログラム名はO番号の形式にそろえる。'''
+        pending = list(folders)
+        while pending:
+            folder = pending.pop(0)
+            for info in j3.find_dir(folder):
+                if info['type'] == 'folder':
+                    pending.append(folder + info['name'] + '/')
+                else:
+                    yield folder + normalize_name(info['name']), info
+
+    def __object_path(self, digest):
+        return os.path.join(self.__root, 'objects', digest[:2], digest)
+
+    def __host_dir(self, host):
+        return os.path.join(self.__root, 'manifests', host.replace(':', '_'))
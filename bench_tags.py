@@ -0,0 +1,70 @@
+# coding: utf-8
+'''
+タグ定義の読み込み・計画作成・デコードの速度と、タグごとのread_dev()との比較
+
+使い方:
+    python bench_tags.py                           # NC無しで、読み込み・計画作成・デコードのみ計測
+    python bench_tags.py tags.json                 # 定義ファイルを指定
+    python bench_tags.py tags.json 192.168.1.10:8193  # NCに接続し、read_tags()とタグごとのread_dev()を比較
+'''
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+from tags import TagMap, TYPES
+
+
+def sample_definition(count=300):
+    '''D11600以降とR6600以降に、型の混ざったタグを並べたサンプル定義を返す。'''
+    definition = {}
+    types = ['int16', 'uint8', 'int32', 'uint16']
+    addr = 11600
+    for i in range(count // 2):
+        type_name = types[i % len(types)]
+        definition['d_%d' % i] = 'D%d:%s' % (addr, type_name)
+        addr += TYPES[type_name][0] + (8 if i % 20 == 19 else 0)
+    for i in range(count - count // 2):
+        definition['r_%d' % i] = 'R%d.%d' % (6600 + i // 8, i % 8)
+    return definition
+
+
+def measure(label, func, number):
+    seconds = timeit.timeit(func, number=number) / number
+    print('%-28s %10.1f us' % (label, seconds * 1e6))
+    return seconds
+
+
+def main(argv):
+    if len(argv) > 1:
+        file_path = argv[1]
+    else:
+        file_path = os.path.join(tempfile.mkdtemp(), 'tags.json')
+        with open(file_path, 'w') as f:
+            json.dump(sample_definition(), f)
+
+    tags = TagMap.load(file_path)
+    plan = tags.plan()
+    print('tags: %d, range reads: %d (per-tag read_dev: %d)' % (len(tags.names()), len(plan), len(tags.names())))
+
+    measure('load', lambda: TagMap.load(file_path), 50)
+    measure('load + compile', lambda: TagMap.load(file_path).compile(), 50)
+    blocks = [bytes(length) for _, length in plan]
+    measure('decode', lambda: tags.decode(blocks), 1000)
+
+    if len(argv) > 2:
+        from j3 import J3
+        j3 = J3.get_connection(argv[2])
+
+        def per_tag():
+            for tag in tags.tags():
+                j3.read_dev(tag.address, size=tag.size)
+
+        measure('read_tags (NC)', lambda: j3.read_tags(tags), 10)
+        measure('per-tag read_dev (NC)', per_tag, 3)
+        j3.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
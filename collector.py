@@ -0,0 +1,157 @@
+# coding: utf-8
+'''
+複数ホストのPMCデバイスを、複数プロセスで並行して収集するコレクター
+
+ホストをワーカープロセスに振り分け、各プロセスが自身でDLLを読み込みJ3の接続を持つ。
+同一プロセス内のJ3はGILとDLL呼び出しのロックを共有するため、プロセスを分けることで
+CPUコア数に応じて収集のスループットを上げる。
+収集結果はバッチにまとめて、キュー経由で親プロセスに返す。
+'''
+import multiprocessing
+import queue
+import time
+
+from util import Interval
+
+
+def _connect(host):
+    '''ワーカープロセス内でJ3の接続を取得する。DLLはこのimportで各プロセスごとに読み込まれる。'''
+    from j3 import J3
+    return J3.get_connection(host)
+
+
+def _worker(hosts, blocks, interval, batch_size, connector, results, stop, max_backoff=30.0):
+    '''ワーカープロセスの処理。担当するホストを周期的に読み出し、結果をバッチで送る。
+
+    エラーになったホストは、待ち時間(周期の2倍から倍々、最大max_backoff秒)が過ぎるまで読み出さない。
+    接続できないホストの接続待ち(最大10秒)で、同じプロセスの他のホストの収集が毎周期止まらないようにする。
+    '''
+    connector = connector or _connect
+    connections = {}
+    # ホスト -> (次に読み出す時刻, 連続でエラーになった回数)
+    backoff = {}
+    batch = []
+    pacing = Interval(interval)
+    while not stop.is_set():
+        for host in hosts:
+            timestamp = time.time()
+            if host in backoff and timestamp < backoff[host][0]:
+                continue
+            try:
+                if host not in connections:
+                    connections[host] = connector(host)
+                j3 = connections[host]
+                batch.append((host, timestamp, [j3.read_range(dev, length) for dev, length in blocks], None))
+                backoff.pop(host, None)
+            except Exception as e:
+                # 接続は待ち時間が過ぎてから取り直す
+                connections.pop(host, None)
+                failures = backoff.get(host, (0, 0))[1] + 1
+                backoff[host] = (time.time() + min(max_backoff, interval * 2 ** min(failures, 20)), failures)
+                batch.append((host, timestamp, None, str(e)))
+            if len(batch) >= batch_size:
+                results.put(batch)
+                batch = []
+        if batch:
+            results.put(batch)
+            batch = []
+        pacing.wait(stop)
+
+    for j3 in connections.values():
+        try:
+            j3.close()
+        except Exception:
+            pass
+
+
+class FleetCollector:
+    '''ホストをワーカープロセスに振り分けて、PMCブロックを周期的に収集する。'''
+
+    def __init__(self, hosts, blocks, interval=1.0, processes=None, batch_size=64, connector=None, max_backoff=30.0):
+        '''
+        Args:
+            hosts (list): IPアドレス:ポート番号のリスト
+            blocks (list): 読み出すブロックのリスト exp) [('R6600', 64), ('D11600', 32)]
+            interval (float): 各ホストの読み出し周期(秒)
+            processes (int): ワーカープロセス数。Noneならmin(CPUコア数, ホスト数)
+            batch_size (int): 1回で親プロセスに送る結果の最大件数
+            connector: ホストを受け取り、read_range()を持つ接続を返す関数（モジュールレベルの関数であること）。
+                       NoneならJ3.get_connection()
+            max_backoff (float): エラーになったホストを、次に読み出すまでの最大の待ち時間(秒)。
+                                 待ち時間は周期の2倍から、エラーが続くごとに倍にする。
+        '''
+        if not hosts:
+            raise Exception('収集するホストを1つ以上設定して下さい。')
+        self.__hosts = list(hosts)
+        self.__blocks = [(dev, int(length)) for dev, length in blocks]
+        self.__interval = interval
+        self.__processes = min(processes or multiprocessing.cpu_count(), len(self.__hosts))
+        self.__batch_size = batch_size
+        self.__connector = connector
+        self.__max_backoff = max_backoff
+        # 各プロセスが独立してDLLを読み込むよう、spawnで起動する
+        self.__context = multiprocessing.get_context('spawn')
+        self.__results = None
+        self.__stop = None
+        self.__workers = []
+
+    def start(self):
+        '''ワーカープロセスを起動し、収集を開始する。'''
+        if self.__workers:
+            return
+        self.__results = self.__context.Queue()
+        self.__stop = self.__context.Event()
+        for i in range(self.__processes):
+            shard = self.__hosts[i::self.__processes]
+            worker = self.__context.Process(
+                target=_worker,
+                args=(shard, self.__blocks, self.__interval, self.__batch_size,
+                    self.__connector, self.__results, self.__stop, self.__max_backoff),
+                daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def stop(self, timeout=10):
+        '''収集を停止し、ワーカープロセスの終了を待つ。'''
+        if not self.__workers:
+            return
+        self.__stop.set()
+        # キューに残った結果を読み捨てないと、ワーカーが終了できない場合がある
+        deadline = time.time() + timeout
+        while any(worker.is_alive() for worker in self.__workers) and time.time() < deadline:
+            try:
+                self.__results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for worker in self.__workers:
+            worker.join(max(0, deadline - time.time()))
+            if worker.is_alive():
+                worker.terminate()
+        self.__workers = []
+
+    def results(self, timeout=None):
+        '''収集結果を1件ずつ返すジェネレーター。
+
+        Args:
+            timeout (float): 結果が届かないまま経過したら終了する秒数。Noneなら停止するまで待つ。
+        Return:
+            generator: (ホスト, 時刻, ブロックごとのbytesのリスト, エラーメッセージ)
+                       読み出しに失敗した場合、ブロックはNoneでエラーメッセージが設定される。
+                       失敗したホストは、待ち時間が過ぎて読み出し直すまで結果を返さない。
+        '''
+        while self.__workers:
+            try:
+                batch = self.__results.get(timeout=timeout if timeout is not None else 0.5)
+            except queue.Empty:
+                if timeout is not None:
+                    return
+                continue
+            for record in batch:
+                yield record
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,58 @@
+# coding: utf-8
+'''
+テスト用の、NCに接続しないJ3の代わり
+
+NC内のプログラムをdictで保持し、プログラムの一覧・読み書きとPMCの範囲読み出しだけを真似る。
+DLLを読み込まないため、Windows以外やNCが無い環境でもテストできる。
+'''
+
+
+class DummyJ3:
+    '''NC内のプログラムをdictで保持する、テスト用の接続。'''
+
+    def __init__(self, programs=None, numeric_names=False):
+        '''
+        Args:
+            programs (dict): プログラム名 -> プログラムの中身(bytes) exp) {'O0001': b'O0001\\nM30'}
+            numeric_names (bool): Trueなら、find_dir()で'O'と先頭の0を付けない名前を返すNCを真似る exp) 'O0001' -> '1'
+        '''
+        self.programs = dict(programs or {})
+        self.dates = {name: '2020/01/01 00:00:00' for name in self.programs}
+        self.numeric_names = numeric_names
+        # 読み込んだプログラムの本数
+        self.read_count = 0
+        # 絶対パス -> 書き込んだデータ
+        self.written = {}
+
+    def find_dir(self, path):
+        return [{'type': 'file', 'name': name[1:].lstrip('0') if self.numeric_names else name,
+                 'size': str(len(data)), 'comment': '', 'date': self.dates[name]}
+            for name, data in sorted(self.programs.items())]
+
+    def iter_file(self, path):
+        self.read_count += 1
+        data = self.programs[path.split('/')[-1]]
+        for i in range(0, len(data), 5):
+            yield data[i:i + 5]
+
+    def read_files(self, paths):
+        self.read_count += len(paths)
+        return {path: self.programs[path.split('/')[-1]] for path in paths}
+
+    def write_file(self, path, data):
+        name = path.split('/')[-1]
+        self.programs[name] = data
+        self.dates[name] = '2020/01/02 00:00:00'
+        self.written[path] = data
+
+    def write_files(self, mapping):
+        for path, data in mapping.items():
+            self.write_file(path, data)
+
+    def read_range(self, dev, length):
+        # アドレス番号の下位バイトを値として返す
+        start = int(dev[1:])
+        return bytes((start + i) % 256 for i in range(length))
+
+    def close(self):
+        pass
@@ -2,11 +2,130 @@
 '''
 マキノJ通信クラス
 '''
-from os import path
+from os import path, makedirs
 from ctypes import *
 from enum import Enum
+from collections import OrderedDict
+from concurrent.futures import Future
+import json
+import queue
+import sys
 import threading
+import time
 import traceback
+from types import MappingProxyType
+
+from ncprog import normalize_name
+from util import write_atomic
+
+
+# --- 例外 ---
+
+class FocasError(Exception):
+    '''FOCASライブラリ関数がエラーを返した。
+
+    Attributes:
+        code (int): エラーコード
+        func (str): エラーを返した関数名
+        host (str): IPアドレス:ポート番号
+        detail (int): cnc_getdtailerrで取得した詳細エラー番号。無い場合はNone
+        retryable (bool): 再試行（または再接続）で回復する可能性があるならTrue
+    '''
+    retryable = False
+
+    def __init__(self, code, message, func=None, host=None, detail=None):
+        self.code = code
+        self.func = func
+        self.host = host
+        self.detail = detail
+        text = 'Error (errcd: ' + str(code) + ') ' + message
+        if func is not None or host is not None:
+            text += ' (func: ' + str(func) + ', host: ' + str(host) + ')'
+        super().__init__(text)
+
+class FocasBusyError(FocasError):
+    '''処理中、バッファが空またはいっぱい。待って再試行すれば回復する。(EW_BUSY, EW_BUFFER)'''
+    retryable = True
+
+class FocasConnectionError(FocasError):
+    '''通信・ハンドルの異常。再接続すれば回復する可能性がある。(EW_SOCKET, EW_PROTOCOL, EW_HANDLE)'''
+    retryable = True
+
+class FocasLibraryError(FocasError):
+    '''ライブラリ自体の異常。(EW_NODLL, EW_VERSION, EW_UNEXP)'''
+
+class FocasNotSupportedError(FocasError):
+    '''機能、PMC、オプションが無い。(EW_FUNC, EW_NOPMC, EW_NOOPT)'''
+
+class FocasDataError(FocasError):
+    '''引数・データの誤り。(EW_LENGTH, EW_NUMBER, EW_ATTRIB, EW_DATA, EW_RANGE, EW_TYPE)'''
+
+class FocasStateError(FocasError):
+    '''CNCの状態により実行できない。(EW_RESET, EW_MODE, EW_REJECT, EW_ALARM, EW_STOP など)'''
+
+class FocasProtectedError(FocasError):
+    '''書き込み禁止、データ保護。(EW_PROT, EW_PASSWD)'''
+
+
+# エラーコード -> (例外クラス, メッセージ)
+_CNC_ERRORS = MappingProxyType({
+    -17 : (FocasConnectionError, '[EW_PROTOCOL] イーサネットボードからのデータが間違っています。'),
+    -16 : (FocasConnectionError, '[EW_SOCKET] CNCの電源、イーサネットケーブル、I/Fボードを調べてください。'),
+    -15 : (FocasLibraryError, '[EW_NODLL] 指定されたノードに対応する各CNCシリーズのDLLファイルがありません。'),
+    -8 : (FocasConnectionError, '[EW_HANDLE] ハンドル番号の誤り。正常なライブラリハンドル番号を取得する。'),
+    -7 : (FocasLibraryError, '[EW_VERSION] CNC/PMCのバージョンは、ライブラリのものと一致しません。'),
+    -6 : (FocasLibraryError, '[EW_UNEXP] 異常な状態のライブラリ。予期しないエラーが発生しました。'),
+    -2 : (FocasStateError, '[EW_RESET] RESETまたはSTOPボタンが押されました。'),
+    -1 : (FocasBusyError, '[EW_BUSY] CNC処理が完了するまで待つか、再試行してください。'),
+    1 : (FocasNotSupportedError, '[EW_FUNC] 関数が実行されていない、または利用できません。'),
+    2 : (FocasDataError, '[EW_LENGTH] データブロック長の誤り、データの数のエラー'),
+    3 : (FocasDataError, '[EW_NUMBER] データ番号の誤り'),
+    4 : (FocasDataError, '[EW_ATTRIB] データ属性の誤り'),
+    5 : (FocasDataError, '[EW_DATA] 指定されたプログラムが見つかりません。'),
+    6 : (FocasNotSupportedError, '[EW_NOOPT] 該当するCNCオプションがありません。'),
+    7 : (FocasProtectedError, '[EW_PROT] 書き込み動作が禁止されています。'),
+    8 : (FocasStateError, '[EW_OVRFLOW] CNCテープメモリがオーバーフローしています。'),
+    9 : (FocasStateError, '[EW_PARAM] CNCパラメータが正しく設定されていません。'),
+    10 : (FocasBusyError, '[EW_BUFFER] バッファが空またはいっぱいです。CNC処理が完了するまで待つか、再試行してください。'),
+    11 : (FocasDataError, '[EW_PATH] パス番号が正しくありません。'),
+    12 : (FocasStateError, '[EW_MODE] CNCモードが正しくありません。'),
+    13 : (FocasStateError, '[EW_REJECT] CNCの実行が拒否されます。実行の状態を確認してください。'),
+    14 : (FocasStateError, '[EW_DTSRVR] 一部のエラーは、データ・サーバで発生します。'),
+    15 : (FocasStateError, '[EW_ALARM] CNCのアラームにより機能を実行できません。アラームの原因を取り除いてください。'),
+    16 : (FocasStateError, '[EW_STOP] CNCのステータスが停止または緊急事態です。'),
+    17 : (FocasProtectedError, '[EW_PASSWD] CNCデータ保護機能によって保護されています。')})
+
+# ToDo: エラーコード-16と-17はのイーサネットのエラーは、更に詳細なエラーを表示可能。
+#       必要であれば今後取得するようにする。
+#       詳細は、https://www.inventcom.net/fanuc-focas-library/General/errcode
+_PMC_ERRORS = MappingProxyType({
+    -17 : (FocasConnectionError, '[EW_PROTOCOL] イーサネットボードからのデータが間違っています。'),
+    -16 : (FocasConnectionError, '[EW_SOCKET] CNCの電源、イーサネットケーブル、I/Fボードを調べてください。'),
+    -15 : (FocasLibraryError, '[EW_NODLL] 指定されたノードに対応する各CNCシリーズのDLLファイルがありません。'),
+    -8 : (FocasConnectionError, '[EW_HANDLE] ハンドル番号の誤り。正常なライブラリハンドル番号を取得する。'),
+    -7 : (FocasLibraryError, '[EW_VERSION] CNC/PMCのバージョンは、ライブラリのものと一致しません。'),
+    -6 : (FocasLibraryError, '[EW_UNEXP] 異常な状態のライブラリ。予期しないエラーが発生しました。'),
+    1 : (FocasNotSupportedError, '[EW_NOPMC] PMCは存在しません。'),
+    2 : (FocasDataError, '[EW_LENGTH] データブロック長の誤り'),
+    3 : (FocasDataError, '[EW_RANGE] アドレス範囲エラー'),
+    4 : (FocasDataError, '[EW_TYPE] アドレス型/データ型エラー'),
+    5 : (FocasDataError, '[EW_DATA] データエラー'),
+    6 : (FocasNotSupportedError, '[EW_NOOPT] 該当するCNCオプションはありません。'),
+    10 : (FocasBusyError, '[EW_BUFFER] バッファが空またはいっぱいです。PMC処理が完了するまで待つか、再試行してください。'),
+    17 : (FocasProtectedError, '[EW_PASSWD] データは、CNCデータ保護機能によって保護されています。')})
+
+# EW_DATA(5)の詳細エラー番号 -> メッセージ（関数ごと）
+_UPLOAD4_DETAILS = MappingProxyType({
+    2 : '指定範囲内にプログラムが登録されていない。',
+    3 : 'NCプログラム領域が壊れています。'})
+_DWNSTART4_DETAILS = MappingProxyType({
+    1 : 'フォルダ名の誤り。'})
+_DOWNLOAD4_DETAILS = MappingProxyType({
+    1 : 'NCデータ内の構文の誤り。',
+    2 : 'TVチェック有効の時、ブロック内の文字数(ブロック末尾のLFを含む)が奇数のブロックが検出された。',
+    3 : 'NC指令プログラムの登録本数がオーバーしている。',
+    4 : '同一のプログラム番号が既に登録されている。',
+    5 : '同一のプログラム番号がNC側で選択されている。'})
 
 
 class J3:
@@ -24,6 +143,8 @@ class J3:
     __port = None
     __isopen = False
     __handle = None
+    __cache = None
+    __profile = None
     __dll = cdll.LoadLibrary(path.join(path.dirname(path.abspath(__file__)), 'Fwlibe64.dll'))
     __lock = threading.RLock()
     __offset_dict = {
@@ -52,9 +173,11 @@ class J3:
             self.__dll.cnc_allclibhndl3.argtypes = (c_char_p, c_ushort, c_long, POINTER(c_ushort))
             handle = c_ushort()
             res = self.__dll.cnc_allclibhndl3(bytes(self.__ip, 'utf-8'), c_ushort(int(self.__port)), c_long(10), byref(handle))
-            self.__cnc_raise_error(res)
+            self.__cnc_raise_error(res, 'cnc_allclibhndl3')
             self.__handle = handle
             self.__isopen = True
+        # 初回接続時に、ホストの機能と上限を調べる（調査済みならそれを使う）
+        self.__get_profile()
 
     def close(self):
         '''ライブラリハンドルを解放します。'''
@@ -62,7 +185,7 @@ class J3:
             self.__dll.cnc_freelibhndl.restype = c_short
             self.__dll.cnc_freelibhndl.argtypes = (c_ushort,)
             res = self.__dll.cnc_freelibhndl(self.__handle)
-            self.__cnc_raise_error(res)
+            self.__cnc_raise_error(res, 'cnc_freelibhndl')
             self.__isopen = False
         else:
             pass
@@ -80,6 +203,174 @@ class J3:
                 pass
             return self.__isopen
 
+    # --- 機能と上限のプロファイル ---
+
+    # ホストごとのプロファイル（同じホストは、インスタンスが異なっても調べ直さない）
+    __profiles = {}
+    # プロファイルの保存先ファイル
+    __profile_file = None
+    # cnc_rdpdf_alldir 1回で読み取るエントリ数の上限
+    __dir_page_max = 32
+
+    @classmethod
+    def set_profile_file(cls, file_path):
+        '''プロファイルの保存先ファイルを設定する。ファイルが存在すれば読み込み、次回以降の接続では調べ直さない。
+
+        Args:
+            file_path (str): JSONファイルのパス。Noneなら保存しない。
+        '''
+        with cls.__lock:
+            cls.__profile_file = file_path
+            if file_path is not None and path.exists(file_path):
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    cls.__profiles.update(json.load(f))
+
+    def profile(self, refresh=False):
+        '''接続先のNCの機能と上限を返す。初回接続時に調べた結果を使う。
+
+        Args:
+            refresh (bool): Trueなら調べ直す
+        Return:
+            dict: {'pmc_areas': {'R': [先頭番号, 最終番号], 'D': [先頭番号, 最終番号]},
+                   'pmc_range_max': pmc_rdpmcrng 1回で扱えるバイト数,
+                   'saveprog': 高速プログラム管理(HPM No.11354#7)が有効ならTrue,
+                   'dir_page': cnc_rdpdf_alldir 1回で読み取るエントリ数,
+                   'probed': 調べた日時}
+        '''
+        with self.__lock:
+            self.__open()
+            if refresh:
+                self.__profile = None
+                J3.__profiles.pop(self.__ip + ':' + self.__port, None)
+            profile = self.__get_profile()
+            return dict(profile, pmc_areas=dict(profile['pmc_areas']))
+
+    def __get_profile(self):
+        '''プロファイルを返す。まだ無ければ調べる。
+
+        調べている途中でエラーになった場合は、ハンドルを解放して送出する（次回の接続時に調べ直す）。
+        '''
+        if self.__profile is None:
+            try:
+                self.__profile = J3.__profiles.get(self.__ip + ':' + self.__port) or self.__probe()
+            except:
+                if self.__isopen:
+                    self.__discard_handle()
+                raise
+        return self.__profile
+
+    def __probe(self):
+        '''ホストの機能と上限を調べ、プロファイルとして記録する。'''
+        profile = {
+            'pmc_areas': self.__probe_or(self.__probe_pmc_areas, {}),
+            'saveprog': self.__probe_or(self.__probe_saveprog, False),
+            'dir_page': self.__probe_or(self.__probe_dir_page, 1),
+            'probed': time.strftime('%Y/%m/%d %H:%M:%S'),
+        }
+        profile['pmc_range_max'] = self.__probe_or(self.__probe_pmc_range_max, J3.__pmc_range_max, profile['pmc_areas'])
+        J3.__profiles[self.__ip + ':' + self.__port] = profile
+        if J3.__profile_file is not None:
+            write_atomic(J3.__profile_file, json.dumps(J3.__profiles, indent=1).encode('utf-8'))
+        return profile
+
+    def __probe_or(self, probe, default, *args):
+        '''機能を調べる。未対応などのエラーなら既定値を返す。接続のエラーはそのまま送出する。'''
+        try:
+            return probe(*args)
+        except FocasConnectionError:
+            raise
+        except FocasError:
+            return default
+
+    def __probe_pmc_areas(self):
+        '''pmc_rdpmcinfで、R・Dデバイスのアドレス範囲を返す。'''
+        class INFO(Structure):
+            _fields_ = [
+                ('pmc_adr', c_char), # アドレス種別 'R', 'D' など
+                ('adr_attr', c_char),
+                ('top_num', c_ushort), # 先頭のアドレス番号
+                ('last_num', c_ushort)] # 最終のアドレス番号
+
+        class ODBPMCINF(Structure):
+            _fields_ = [
+                ('datano', c_short), # 有効なinfoの数
+                ('info', INFO * 64)]
+
+        self.__dll.pmc_rdpmcinf.restype = c_short
+        self.__dll.pmc_rdpmcinf.argtypes = (c_ushort, c_short, POINTER(ODBPMCINF))
+        pmcinf = ODBPMCINF()
+        res = self.__dll.pmc_rdpmcinf(self.__handle, c_short(0), byref(pmcinf)) # 0: バイト型
+        self.__pmc_raise_error(res, 'pmc_rdpmcinf')
+        areas = {}
+        for info in pmcinf.info[:pmcinf.datano]:
+            name = info.pmc_adr.decode('ascii', 'replace')
+            if name in ('R', 'D'):
+                areas[name] = [info.top_num, info.last_num]
+        return areas
+
+    def __probe_pmc_range_max(self, areas):
+        '''pmc_rdpmcrng 1回で読み出せる最大バイト数を返す。
+
+        Dデバイス（無ければRデバイス）の先頭から、EW_LENGTHになるまでバイト数を倍にして読み出し、
+        最後に成功したバイト数と失敗したバイト数の間を二分探索する。書き込みも同じ上限を使う。
+        '''
+        name = 'D' if 'D' in areas or 'R' not in areas else 'R'
+        top, last = areas.get(name, (0, J3.__pmc_range_limit - 1))
+        type_a = J3.parse_area(name + '0')[0]
+        upper = min(J3.__pmc_range_limit, last - top + 1)
+
+        self.__dll.pmc_rdpmcrng.restype = c_short
+        self.__dll.pmc_rdpmcrng.argtypes = (c_ushort, c_short, c_short, c_ushort, c_ushort, c_ushort, c_void_p)
+        def readable(n):
+            iodbpmc = J3.__pmc_range_type(n)()
+            res = self.__dll.pmc_rdpmcrng(self.__handle, c_short(type_a), c_short(0), c_ushort(top), c_ushort(top + n - 1), 8 + n, byref(iodbpmc))
+            # EW_LENGTH, EW_RANGE は長すぎる
+            if res in (2, 3):
+                return False
+            self.__pmc_raise_error(res, 'pmc_rdpmcrng')
+            return True
+
+        good, bad = 0, None
+        n = min(J3.__pmc_range_max, upper)
+        while good < upper:
+            if not readable(n):
+                bad = n
+                break
+            good, n = n, min(n * 2, upper)
+        if bad is not None:
+            while bad - good > 1:
+                mid = (good + bad) // 2
+                if readable(mid):
+                    good = mid
+                else:
+                    bad = mid
+        return good or J3.__pmc_range_max
+
+    def __probe_saveprog(self):
+        '''cnc_rdparamで、高速プログラム管理(HPM No.11354#7)が有効か返す。'''
+        class IODBPSD(Structure):
+            _fields_ = [
+                ('datano', c_short), # パラメータ番号
+                ('type', c_short), # 軸番号
+                ('cdata', c_ubyte), # ビット型・バイト型パラメータの値
+                ('dummy', c_ubyte * 255)] # 軸型パラメータ用の領域
+
+        self.__dll.cnc_rdparam.restype = c_short
+        self.__dll.cnc_rdparam.argtypes = (c_ushort, c_short, c_short, c_short, POINTER(IODBPSD))
+        param = IODBPSD()
+        res = self.__dll.cnc_rdparam(self.__handle, c_short(11354), c_short(0), c_short(4 + 1), byref(param))
+        self.__cnc_raise_error(res, 'cnc_rdparam')
+        return bool(param.cdata & 0b10000000)
+
+    def __probe_dir_page(self):
+        '''cnc_rdpdf_alldirで、1回に複数のエントリを読み取れるか調べ、読み取るエントリ数を返す。
+
+        ルートフォルダのエントリを最大数要求し、2件以上返ってきた場合だけ複数件を要求する。
+        '''
+        if self.__rdpdf_alldir('//CNC_MEM/', 0, (J3.ODBPDFADIR * J3.__dir_page_max)()) > 1:
+            return J3.__dir_page_max
+        return 1
+
     # --- NCプログラムファイル操作関連 ---
 
     def exist_file(self, path):
@@ -103,7 +394,7 @@ class J3:
             elif res == 5:
                 return False
             else:
-                self.__cnc_raise_error(res)
+                self.__cnc_raise_error(res, 'cnc_search')
 
     def read_file(self, path):
         '''NCプログラムを読み込む。
@@ -115,77 +406,181 @@ class J3:
         '''
         with self.__lock:
             self.__open()
-            result = b''
 
             if not self.exist_file(path):
                 raise Exception('指定された加工プログラムが存在しません。(path: ' + str(path) + ')')
 
-            # EW_DATA(5): データの誤り の詳細エラー内容
-            ew_data_errmap = {
-                2 : '指定範囲内にプログラムが登録されていない。',
-                3 : 'NCプログラム領域が壊れています。'}
+            return self.__upload(path, create_string_buffer(1025))
 
-            # 返り値と引数定義
-            self.__dll.cnc_upstart4.restype = c_short
-            self.__dll.cnc_upstart4.argtypes = (c_ushort, c_short, c_char_p)
-            self.__dll.cnc_upload4.restype = c_short
-            self.__dll.cnc_upload4.argtypes = (c_ushort, POINTER(c_long), c_char_p)
-            self.__dll.cnc_upend4.restype = c_short
-            self.__dll.cnc_upend4.argtypes = (c_ushort,)
+    def read_files(self, paths, out_dir=None):
+        '''複数のNCプログラムをまとめて読み込む。
+
+        存在確認はフォルダごとに1回のfind_dir()で行い、転送バッファは使い回す。
+        out_dirを指定した場合、ファイルへの保存は別スレッドで行い、次のプログラムの転送と並行させる。
 
+        Args:
+            paths (list): 絶対パスのリスト
+            out_dir (str): 保存先のローカルフォルダ。Noneなら保存しない。
+        Return:
+            dict: 絶対パス -> プログラムの中身(bytes)
+        '''
+        result = {}
+        saver = _FileSaver(out_dir) if out_dir is not None else None
+        try:
+            with self.__lock:
+                self.__open()
+
+                # 存在しないプログラムがあれば、転送を始める前にエラーにする
+                listing = self.__list_programs(paths)
+                for path in paths:
+                    if normalize_name(path.split('/')[-1]) not in listing[J3.__dir_name(path)]:
+                        raise Exception('指定された加工プログラムが存在しません。(path: ' + str(path) + ')')
+
+                buf = create_string_buffer(1025)
+                for path in paths:
+                    result[path] = self.__upload(path, buf)
+                    if saver is not None:
+                        saver.put(path.split('/')[-1], result[path])
+        finally:
+            if saver is not None:
+                saver.close()
+        return result
+
+    def iter_file(self, path):
+        '''NCプログラムを、受信したデータごとに返すジェネレーター。
+
+        受信は別スレッドで行い、ロックは受信している間だけ保持する。
+        呼び出し元の処理が遅くても他のデバイス読み書きや転送は止まらず、未処理のデータはメモリに溜める（最大でプログラム全体）。
+        途中でジェネレーターを閉じた場合は、次の受信の区切りで転送を終了し、終了を待ってから戻る。
+
+        Args:
+            path (str): 絶対パス
+        Return:
+            generator: プログラムの中身を分割したbytes
+        '''
+        received = queue.Queue()
+        stop = threading.Event()
+
+        def receive():
             try:
-                # CNC側にNCプログラムのRead開始を要求
-                data_type = c_short(0) # 0: NC指令プログラム
-                file_name_p = c_char_p(create_string_buffer(bytes(path, 'utf-8')).raw) # Readするファイル名
-                res = self.__dll.cnc_upstart4(self.__handle, data_type, file_name_p)
-                self.__cnc_raise_error(res)
-
-                # NCデータのReadを行う
-                data_p = c_char_p(create_string_buffer(1024).raw)
-                while True:
-                    length_p = c_long(1024) # ポインタ実際に出力された文字数がセットされます
-                    res = self.__dll.cnc_upload4(self.__handle, byref(length_p), data_p)
-
-                    # EW_OK（正常完了）
-                    if res == 0:
-                        begin_len = 2 if data_p.value.find(b'%\n') != 1 else None # 先頭の場合、先頭文字のb'%\n'を取り除く
-                        last_position = data_p.value.find(b'\n%') # 行末文字のb'\n%'が何行目か検索
-                        end_len = last_position if last_position != -1 else None
-                        result += data_p.value[begin_len:end_len]
-                        # 末文字があればRead終了
-                        if last_position != -1:
-                            break
-                    # EW_DATA (エラー詳細あり)
-                    elif res == 5:
-                        detail_err = self.__cnc_getdtailerr()
-                        raise Exception(ew_data_errmap[detail_err])
-                    # EW_BUFFER（バッファがフル状態なのでリトライ）
-                    elif res == 10:
-                        continue
-                    else:
-                        self.__cnc_raise_error(res)
-                    
-                # NCデータのRead終了を通知
-                res = self.__dll.cnc_upend4(self.__handle)
+                with self.__lock:
+                    self.__open()
+
+                    if stop.is_set():
+                        return
+                    if not self.exist_file(path):
+                        raise Exception('指定された加工プログラムが存在しません。(path: ' + str(path) + ')')
+
+                    chunks = self.__upload_chunks(path, create_string_buffer(1025))
+                    try:
+                        for chunk in chunks:
+                            if stop.is_set():
+                                break
+                            received.put(chunk)
+                    finally:
+                        # 転送を終了してからロックを解放する
+                        chunks.close()
+                received.put(None)
+            except BaseException as e:
+                received.put(e)
+
+        thread = threading.Thread(target=receive, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = received.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # 転送の終了(cnc_upend4)を待ってから戻る。戻った後に接続を閉じても、受信中のハンドルを解放しない
+            stop.set()
+            thread.join()
+
+    def __upload(self, path, buf):
+        '''NCプログラムをアップロードして返す。存在確認は呼び出し元で行うこと。
 
+        Args:
+            path (str): 絶対パス
+            buf: 転送に使うバッファ（create_string_buffer(1025)）
+        Return:
+            bytes: プログラムの中身
+        '''
+        return b''.join(self.__upload_chunks(path, buf))
+
+    def __upload_chunks(self, path, buf):
+        '''NCプログラムをアップロードし、受信したデータごとに返すジェネレーター。存在確認は呼び出し元で行うこと。'''
+        # 返り値と引数定義
+        self.__dll.cnc_upstart4.restype = c_short
+        self.__dll.cnc_upstart4.argtypes = (c_ushort, c_short, c_char_p)
+        self.__dll.cnc_upload4.restype = c_short
+        self.__dll.cnc_upload4.argtypes = (c_ushort, POINTER(c_long), c_char_p)
+        self.__dll.cnc_upend4.restype = c_short
+        self.__dll.cnc_upend4.argtypes = (c_ushort,)
+
+        try:
+            # CNC側にNCプログラムのRead開始を要求
+            data_type = c_short(0) # 0: NC指令プログラム
+            file_name_p = c_char_p(create_string_buffer(bytes(path, 'utf-8')).raw) # Readするファイル名
+            res = self.__dll.cnc_upstart4(self.__handle, data_type, file_name_p)
+            self.__cnc_raise_error(res, 'cnc_upstart4')
+
+            # NCデータのReadを行う
+            first = True
+            rest = b'' # 前回の末尾の'LF'。次のデータの先頭の'%'と合わせて末文字になる可能性がある
+            while True:
+                length_p = c_long(len(buf) - 1) # ポインタ実際に出力された文字数がセットされます
+                res = self.__dll.cnc_upload4(self.__handle, byref(length_p), buf)
+
+                # EW_OK（正常完了）
+                if res == 0:
+                    chunk = rest + string_at(buf, length_p.value) # バッファを使い回すため、出力された文字数分だけ取り出す
+                    # 最初のデータの場合だけ、先頭文字のb'%\n'を取り除く
+                    if first and chunk.startswith(b'%\n'):
+                        chunk = chunk[2:]
+                    first = False
+                    last_position = chunk.find(b'\n%') # 行末文字のb'\n%'の位置を検索
+                    # 末文字があればRead終了
+                    if last_position != -1:
+                        if last_position > 0:
+                            yield chunk[:last_position]
+                        break
+                    rest = b'\n' if chunk.endswith(b'\n') else b''
+                    if len(chunk) > len(rest):
+                        yield chunk[:len(chunk) - len(rest)]
                 # EW_DATA (エラー詳細あり)
-                if res == 5:
-                    detail_err = self.__cnc_getdtailerr()
-                    raise Exception(ew_data_errmap[detail_err])
+                elif res == 5:
+                    raise self.__cnc_data_error('cnc_upload4', _UPLOAD4_DETAILS)
+                # EW_BUFFER（バッファがフル状態なのでリトライ）
+                elif res == 10:
+                    continue
                 else:
-                    self.__cnc_raise_error(res)
-            except:
-                res = self.__dll.cnc_upend4(self.__handle)
-                self.__cnc_raise_error(res)
+                    self.__cnc_raise_error(res, 'cnc_upload4')
 
-            return result
+            # NCデータのRead終了を通知
+            res = self.__dll.cnc_upend4(self.__handle)
 
-    def write_file(self, path, data):
+            # EW_DATA (エラー詳細あり)
+            if res == 5:
+                raise self.__cnc_data_error('cnc_upend4', _UPLOAD4_DETAILS)
+            else:
+                self.__cnc_raise_error(res, 'cnc_upend4')
+        except:
+            # 転送を終了してから、元の例外を送出する（ジェネレーターを閉じた場合も含む）
+            res = self.__dll.cnc_upend4(self.__handle)
+            self.__cnc_raise_error(res, 'cnc_upend4')
+            raise
+
+    def write_file(self, path, data, progress=None):
         '''NCプログラムを書き込む。
 
         Args:
             path (str): 絶対パス
             data (bytes): 書き込むデータをバイナリで渡す。
+            progress: 送信の度に(送信済みバイト数, 全体のバイト数)で呼ばれる関数。例外を送出すると転送を中止する
+                      （既存のプログラムは削除済みのため、プログラムが無い状態になる）。
         '''
         with self.__lock:
             self.__open()
@@ -194,80 +589,151 @@ class J3:
             if self.exist_file(path):
                 # ダミーPGを存在確認し、本来の消す対象の選択状態を先に外す
                 self.exist_file('//CNC_MEM/USER/LIBRARY/O8999')
-                self.delete_file(path)
-            
-            # EW_DATA(5): データの誤り の詳細エラー内容
-            dwnstart4_errmap = {
-                1 : 'フォルダ名の誤り。'}
-            download4_errmap = {
-                1 : 'NCデータ内の構文の誤り。',
-                2 : 'TVチェック有効の時、ブロック内の文字数(ブロック末尾のLFを含む)が奇数のブロックが検出された。',
-                3 : 'NC指令プログラムの登録本数がオーバーしている。',
-                4 : '同一のプログラム番号が既に登録されている。',
-                5 : '同一のプログラム番号がNC側で選択されている。'}
+                self.__delete(path)
 
-            # 返り値と引数定義
-            self.__dll.cnc_dwnstart4.restype = c_short
-            self.__dll.cnc_dwnstart4.argtypes = (c_ushort, c_short, c_char_p)
-            self.__dll.cnc_download4.restype = c_short
-            self.__dll.cnc_download4.argtypes = (c_ushort, POINTER(c_long), c_char_p)
-            self.__dll.cnc_dwnend4.restype = c_short
-            self.__dll.cnc_dwnend4.argtypes = (c_ushort,)
+            self.__download(path, data, create_string_buffer(1025), progress)
+            # 高速プログラム管理が有効なら、不揮発性メモリに保存する
+            if self.__get_profile()['saveprog']:
+                self.__cnc_saveprog_start()
 
-            try:
-                # CNC側にNCプログラムのWrite開始を要求
-                data_type = c_short(0) # 0: NC指令プログラム
-                dir_name_p = c_char_p(create_string_buffer(bytes('//CNC_MEM/USER/LIBRARY/', 'utf-8')).raw) # Writeするディレクトリ名
-                res = self.__dll.cnc_dwnstart4(self.__handle, data_type, dir_name_p)
-                
-                # EW_DATA (エラー詳細あり)
-                if res == 5:
-                    detail_err = self.__cnc_getdtailerr()
-                    raise Exception(dwnstart4_errmap[detail_err])
-                else:
-                    self.__cnc_raise_error(res)
+    def write_files(self, mapping):
+        '''複数のNCプログラムをまとめて書き込む。
+
+        存在確認はフォルダごとに1回のfind_dir()で行い、既存プログラムの選択解除（ダミーPGの検索）は1回だけ行う。
+        ローカルファイルの読み込みは別スレッドで先読みし、転送と並行させる。
+        高速プログラム管理が有効な場合、不揮発性メモリへの保存は全て書き込んだ後に1回だけ行う。
+
+        Args:
+            mapping (dict): 絶対パス -> 書き込むデータ(bytes)、またはローカルファイルのパス(str)
+        '''
+        paths = list(mapping)
+        loader = _FileLoader([mapping[path] for path in paths])
+        try:
+            with self.__lock:
+                self.__open()
+
+                # 既存のプログラムを先にまとめて削除
+                listing = self.__list_programs(paths)
+                exists = [path for path in paths if normalize_name(path.split('/')[-1]) in listing[J3.__dir_name(path)]]
+                if exists:
+                    # ダミーPGを存在確認し、本来の消す対象の選択状態を先に外す
+                    self.exist_file('//CNC_MEM/USER/LIBRARY/O8999')
+                    for path in exists:
+                        self.__delete(path)
+
+                buf = create_string_buffer(1025)
+                for path in paths:
+                    self.__download(path, loader.get(), buf)
+                # 高速プログラム管理が有効なら、最後に1回だけ不揮発性メモリに保存する
+                if self.__get_profile()['saveprog']:
+                    self.__cnc_saveprog_start()
+        finally:
+            loader.close()
+
+    def start_read_file(self, path, out_path=None, retries=3):
+        '''NCプログラムの読み込みを、バックグラウンドで開始する。
+
+        転送は専用の接続で行う。接続が切れた場合は再接続して読み直し、受信済みの分は読み飛ばす。
+
+        Args:
+            path (str): 絶対パス
+            out_path (str): 読み込んだプログラムを保存するローカルのパス。Noneなら保存しない。
+            retries (int): 失敗時に再試行する回数
+        Return:
+            TransferJob: 転送ジョブ。result()でプログラムの中身を返す。
+        '''
+        return TransferJob(self.__ip + ':' + self.__port, path, out_path=out_path, retries=retries)
+
+    def start_write_file(self, path, data, retries=3):
+        '''NCプログラムの書き込みを、バックグラウンドで開始する。
+
+        転送は専用の接続で行う。失敗した場合は再接続して最初から書き込み直す。
+        既存のプログラムは削除してから書き込むため、書き込みを始めた後はcancel()できない。
+        再試行しても失敗した場合は、既存のプログラムが削除されたままになる。
+
+        Args:
+            path (str): 絶対パス
+            data (bytes): 書き込むデータ
+            retries (int): 失敗時に再試行する回数
+        Return:
+            TransferJob: 転送ジョブ
+        '''
+        return TransferJob(self.__ip + ':' + self.__port, path, data=data, retries=retries)
+
+    def __download(self, path, data, buf, progress=None):
+        '''NCプログラムをダウンロードする。既存プログラムの削除は呼び出し元で行うこと。
+
+        Args:
+            path (str): 絶対パス
+            data (bytes): 書き込むデータ
+            buf: 転送に使うバッファ（create_string_buffer(1025)）
+            progress: 送信の度に(送信済みバイト数, 全体のバイト数)で呼ばれる関数
+        '''
+        # 返り値と引数定義
+        self.__dll.cnc_dwnstart4.restype = c_short
+        self.__dll.cnc_dwnstart4.argtypes = (c_ushort, c_short, c_char_p)
+        self.__dll.cnc_download4.restype = c_short
+        self.__dll.cnc_download4.argtypes = (c_ushort, POINTER(c_long), c_char_p)
+        self.__dll.cnc_dwnend4.restype = c_short
+        self.__dll.cnc_dwnend4.argtypes = (c_ushort,)
+
+        try:
+            # CNC側にNCプログラムのWrite開始を要求
+            data_type = c_short(0) # 0: NC指令プログラム
+            dir_name_p = c_char_p(create_string_buffer(bytes(J3.__dir_name(path), 'utf-8')).raw) # Writeするディレクトリ名
+            res = self.__dll.cnc_dwnstart4(self.__handle, data_type, dir_name_p)
+            
+            # EW_DATA (エラー詳細あり)
+            if res == 5:
+                raise self.__cnc_data_error('cnc_dwnstart4', _DWNSTART4_DETAILS)
+            else:
+                self.__cnc_raise_error(res, 'cnc_dwnstart4')
+            
+            # Writeするデータを整形し、バッファサイズごとに配列に格納
+            size = len(buf) - 1
+            format_data = b'\n' + data + b'\n%' # データ全体の先頭には'LF'を、末尾には'LF%'を付加
+            splited_data = [format_data[i:i+size] for i in range(0, len(format_data), size)] # バッファサイズごとに分割
+
+            count = 0
+            while True:
+                # NCデータのWriteを行う
+                chunk = splited_data[count]
+                memmove(buf, chunk, len(chunk))
+                length = c_long(len(chunk))
+                res = self.__dll.cnc_download4(self.__handle, byref(length), buf)
                 
-                # Writeするデータを整形し、1024ごとに配列に格納
-                format_data = b'\n' + data + b'\n%' # データ全体の先頭には'LF'を、末尾には'LF%'を付加
-                splited_data = [format_data[i:i+1024] for i in range(0, len(format_data), 1024)] # 1024ごとに分割
-
-                count = 0
-                while True:
-                    # NCデータのWriteを行う
-                    data_p = c_char_p(create_string_buffer(splited_data[count]).raw)
-                    length = c_long(1024)
-                    res = self.__dll.cnc_download4(self.__handle, byref(length), data_p)
-                    
-                    # EW_OK（正常完了）
-                    if res == 0:
-                        # Writeしたデータに末文字があれば終了
-                        if data_p.value[-1:] == b'%':
-                            break
-                        else:
-                            count += 1
-                    # EW_DATA (エラー詳細あり)
-                    elif res == 5:
-                        detail_err = self.__cnc_getdtailerr()
-                        raise Exception(download4_errmap[detail_err])
-                    # EW_BUFFER（バッファがフル状態なのでリトライ）
-                    elif res == 10:
-                        continue
+                # EW_OK（正常完了）
+                if res == 0:
+                    if progress is not None:
+                        progress(min(len(format_data), (count + 1) * size), len(format_data))
+                    # Writeしたデータに末文字があれば終了
+                    if chunk[-1:] == b'%':
+                        break
                     else:
-                        self.__cnc_raise_error(res)
-                
-                # NCデータのWrite終了を通知
-                res = self.__dll.cnc_dwnend4(self.__handle)
-                
+                        count += 1
                 # EW_DATA (エラー詳細あり)
-                if res == 5:
-                    detail_err = self.__cnc_getdtailerr()
-                    raise Exception(download4_errmap[detail_err])
+                elif res == 5:
+                    raise self.__cnc_data_error('cnc_download4', _DOWNLOAD4_DETAILS)
+                # EW_BUFFER（バッファがフル状態なのでリトライ）
+                elif res == 10:
+                    continue
                 else:
-                    self.__cnc_raise_error(res)
+                    self.__cnc_raise_error(res, 'cnc_download4')
+            
+            # NCデータのWrite終了を通知
+            res = self.__dll.cnc_dwnend4(self.__handle)
+            
+            # EW_DATA (エラー詳細あり)
+            if res == 5:
+                raise self.__cnc_data_error('cnc_dwnend4', _DOWNLOAD4_DETAILS)
+            else:
+                self.__cnc_raise_error(res, 'cnc_dwnend4')
 
-            except:
-                res = self.__dll.cnc_dwnend4(self.__handle)
-                self.__cnc_raise_error(res)
+        except:
+            # 転送を終了してから、元の例外を送出する
+            res = self.__dll.cnc_dwnend4(self.__handle)
+            self.__cnc_raise_error(res, 'cnc_dwnend4')
+            raise
 
     def delete_file(self, path):
         '''NCプログラムを削除する。
@@ -285,17 +751,42 @@ class J3:
 
             # ダミーPGを存在確認し、本来の消す対象の選択状態を先に外す
             self.exist_file('//CNC_MEM/USER/LIBRARY/O8999')
-            
-            # 返り値と引数定義
-            self.__dll.cnc_delete.restype = c_short
-            self.__dll.cnc_delete.argtypes = (c_ushort, c_short)
+            self.__delete(path)
 
-            # ファイルの削除を行う
-            res = self.__dll.cnc_delete(self.__handle, c_short(int(filenm[1:])))
-            if res == 5:
-                pass # 'プログラム(number)が見つかりません。'はスキップ
-            else:
-                self.__cnc_raise_error(res)
+    def __delete(self, path):
+        '''NCプログラムを削除する。ダミーPGによる選択解除は呼び出し元で行うこと。'''
+        filenm = path.split('/')[-1]
+        if filenm[0:1] != 'O':
+            raise Exception('加工PGのみ削除可能。')
+
+        # 返り値と引数定義
+        self.__dll.cnc_delete.restype = c_short
+        self.__dll.cnc_delete.argtypes = (c_ushort, c_short)
+
+        # ファイルの削除を行う
+        res = self.__dll.cnc_delete(self.__handle, c_short(int(filenm[1:])))
+        if res == 5:
+            pass # 'プログラム(number)が見つかりません。'はスキップ
+        else:
+            self.__cnc_raise_error(res, 'cnc_delete')
+
+    @staticmethod
+    def __dir_name(path):
+        '''絶対パスからフォルダ名（末尾の/を含む）を返す。'''
+        return path[:path.rfind('/') + 1]
+
+    def __list_programs(self, paths):
+        '''パスのフォルダごとにfind_dir()を1回だけ呼び出し、プログラム名の一覧を返す。
+
+        Return:
+            dict: フォルダ名 -> 正規化したプログラム名のset
+        '''
+        listing = {}
+        for path in paths:
+            dir_name = J3.__dir_name(path)
+            if dir_name not in listing:
+                listing[dir_name] = {normalize_name(info['name']) for info in self.find_dir(dir_name) if info['type'] == 'file'}
+        return listing
 
     def __cnc_saveprog_start(self):
         '''(未テスト)高速プログラム管理でプログラム保存する。
@@ -314,12 +805,10 @@ class J3:
             self.__dll.cnc_saveprog_start.restype = c_short
             self.__dll.cnc_saveprog_start.argtypes = (c_ushort,)
             res = self.__dll.cnc_saveprog_start(self.__handle)
-            self.__cnc_raise_error(res)
-
-            if res == 13:
-                self.__cnc_saveprog_end()
-            else:
-                self.__cnc_raise_error(res)
+            # EW_REJECT (保存中) の場合も、保存の完了を待つ
+            if res != 13:
+                self.__cnc_raise_error(res, 'cnc_saveprog_start')
+            self.__cnc_saveprog_end()
 
     def __cnc_saveprog_end(self):
         '''(未テスト)高速プログラム管理が有効（NCパラメータHPM(No.11354#7)=1）の場合、
@@ -336,11 +825,13 @@ class J3:
                 res = self.__dll.cnc_saveprog_end(self.__handle, byref(result_p))
                 # EW_BUSY (BYSYなら再試行)
                 if res == -1:
+                    time.sleep(0.01)
                     continue
                 else:
-                    self.__cnc_raise_error(res)
+                    self.__cnc_raise_error(res, 'cnc_saveprog_end')
                 # 結果
-                self.__cnc_raise_error(result_p.value)
+                self.__cnc_raise_error(result_p.value, 'cnc_saveprog_end')
+                break
 
     # --- NCディレクトリ操作関連 --
 
@@ -378,47 +869,57 @@ class J3:
             path (str): ディレクトリパス exp) //CNC_MEM/
         Return:
             list: 検索結果のリスト。中身は辞書データで1件ごとのデータを管理。
-                  exp) [{ 'type': 'file', 'name': '100', 'size': '19', 'comment': 'BY IKEHARA' }, ...]
+                  exp) [{ 'type': 'file', 'name': '100', 'size': '19', 'comment': 'BY IKEHARA', 'date': '2020/01/31 12:00:00' }, ...]
         '''
         with self.__lock:
             self.__open()
             result = []
 
-            num_prog_p = c_short(2) # 読み取るプログラムの最大個数を設定。ポインタなので、実際に読み取った際のプログラム個数が設定される
-            path_bytes = create_string_buffer(bytes(path, 'utf-8')).raw
-
-            # 返り値と引数定義
-            pdf_adir_in = J3.IDBPDFADIR() # フォルダの設定値
-            pdf_adir_in.path = path_bytes # パス名文字列
-            pdf_adir_in.req_num = c_short(0) # 要求エントリ番号。0始まりで、1ずつインクリメントする。
-            pdf_adir_in.size_kind = 1 # byte表示
-            pdf_adir_in.type = 1 # サイズ、コメント、加工時間スタンプを取得
-            pdf_adir_out = J3.ODBPDFADIR() # フォルダの一覧情報
-
-            self.__dll.cnc_rdpdf_alldir.restype = c_short
-            self.__dll.cnc_rdpdf_alldir.argtypes = (c_ushort, POINTER(c_short), POINTER(J3.IDBPDFADIR), POINTER(J3.ODBPDFADIR))
+            # 1回に読み取るエントリ数はプロファイルに従う
+            page = self.__get_profile()['dir_page']
+            entries = (J3.ODBPDFADIR * page)()
+            req_num = 0 # 要求エントリ番号。0始まり
             while True:
-                res = self.__dll.cnc_rdpdf_alldir(self.__handle, byref(num_prog_p), byref(pdf_adir_in), byref(pdf_adir_out))
-                self.__cnc_raise_error(res)
-
-                # 実際に読み取ったプログラムの数が0なら即終了
-                if num_prog_p.value == 0:
+                num = self.__rdpdf_alldir(path, req_num, entries)
+                for pdf_adir_out in entries[:num]:
+                    result.append({
+                        'type': 'folder' if pdf_adir_out.data_kind == 0 else 'file',
+                        'name': pdf_adir_out.d_f.decode(),
+                        'size': str(pdf_adir_out.size),
+                        'comment': pdf_adir_out.comment.decode(),
+                        'date': '%04d/%02d/%02d %02d:%02d:%02d' % (
+                            pdf_adir_out.year, pdf_adir_out.mon, pdf_adir_out.day,
+                            pdf_adir_out.hour, pdf_adir_out.min, pdf_adir_out.sec)
+                    })
+                # 1回に返す数が要求より少ないNCもあるため、0件になるまで読み込む
+                if num == 0:
                     break
-
-                data = {
-                    'type': 'folder' if pdf_adir_out.data_kind == 0 else 'file',
-                    'name': pdf_adir_out.d_f.decode(),
-                    'size': str(pdf_adir_out.size),
-                    'comment': pdf_adir_out.comment.decode()
-                }
-                result.append(data)
-                # 最後の1ファイルを読み込んだら終了
-                if num_prog_p.value <= 1:
-                    break
-                else:
-                    pdf_adir_in.req_num += 1
+                req_num += num
             return result
 
+    def __rdpdf_alldir(self, path, req_num, entries):
+        '''cnc_rdpdf_alldirで、フォルダのエントリを要求エントリ番号から最大len(entries)件読み取る。
+
+        Args:
+            path (str): ディレクトリパス
+            req_num (int): 要求エントリ番号
+            entries: ODBPDFADIRの配列
+        Return:
+            int: 実際に読み取ったエントリ数
+        '''
+        pdf_adir_in = J3.IDBPDFADIR() # フォルダの設定値
+        pdf_adir_in.path = create_string_buffer(bytes(path, 'utf-8')).raw # パス名文字列
+        pdf_adir_in.req_num = req_num
+        pdf_adir_in.size_kind = 1 # byte表示
+        pdf_adir_in.type = 1 # サイズ、コメント、加工時間スタンプを取得
+        num_prog_p = c_short(len(entries)) # 読み取るエントリの最大個数。実際に読み取った個数が設定される
+
+        self.__dll.cnc_rdpdf_alldir.restype = c_short
+        self.__dll.cnc_rdpdf_alldir.argtypes = (c_ushort, POINTER(c_short), POINTER(J3.IDBPDFADIR), POINTER(J3.ODBPDFADIR))
+        res = self.__dll.cnc_rdpdf_alldir(self.__handle, byref(num_prog_p), byref(pdf_adir_in), entries)
+        self.__cnc_raise_error(res, 'cnc_rdpdf_alldir')
+        return num_prog_p.value
+
     # --- NCデバイス操作関連 ---
 
     class IODBPMC(Structure):
@@ -449,6 +950,12 @@ class J3:
             int: 読み出したデータの値を返す。但しオフセット有りの場合は、ビット（0 or 1）を返す。
         '''
         with self.__lock:
+            # キャッシュ有効時、TTLが設定されたアドレスはキャッシュから返す
+            if self.__cache is not None:
+                data = self.__read_cache(dev, size)
+                if data is not None:
+                    return data
+
             self.__open()
 
             iodbpmc = J3.IODBPMC()
@@ -505,7 +1012,8 @@ class J3:
                 c_ushort(int(devno[1:]) + add_index), # 終了するPMCアドレス番号
                 8 + add_length, # data_type = 0(バイト型):8+N, 1(ワード型):8+(N*2), 2(ロング型):8+(N*4) ※但しNは読み取るデータの個数
                 byref(iodbpmc))
-            self.__pmc_raise_error(res)
+            if res != 0:
+                self.__pmc_raise_error(res, 'pmc_rdpmcrng')
 
             # readした値を取得
             data = None
@@ -555,14 +1063,12 @@ class J3:
                 if offset > 7 or 0 > offset:
                     raise Exception('書き込むデバイスのオフセット値が不正です。0~7の範囲内で指定してください。')
 
-                # 指定したオフセットだけの書き込みができないため、一度デバイスの値を読み込み、書き込む値を更新する。
-                val = self.read_dev(devno)
-                if in_data == 1 and val & self.__offset_dict[offset] == 0:
-                    data = val + self.__offset_dict[offset]
-                elif in_data == 0 and val & self.__offset_dict[offset] != 0:
-                    data = val - self.__offset_dict[offset]
+                # 指定したオフセットだけの書き込みができないため、対象のバイトを読み込み、ビットだけを更新して書き込む。
+                if in_data == 1:
+                    self.set_bits(devno, self.__offset_dict[offset])
                 else:
-                    data = val
+                    self.clear_bits(devno, self.__offset_dict[offset])
+                return
             # オフセット無し
             else:
                 devno = dev
@@ -610,85 +1116,377 @@ class J3:
             self.__dll.pmc_wrpmcrng.restype = c_short
             self.__dll.pmc_wrpmcrng.argtypes = (c_ushort, c_short, POINTER(J3.IODBPMC))
             res = self.__dll.pmc_wrpmcrng(self.__handle, 8 + add_length, byref(iodbpmc))
-            self.__pmc_raise_error(res)
+            if res != 0:
+                self.__pmc_raise_error(res, 'pmc_wrpmcrng')
+
+            if self.__cache is not None:
+                self.__cache.invalidate(type_a, int(devno[1:]), add_length)
+
+    # 範囲読み書き時に、pmc_rdpmcrng/pmc_wrpmcrng 1回で扱うバイト数（プロファイルで上限を調べられなかった場合）
+    __pmc_range_max = 256
+    # 上限を調べる際の最大バイト数（データ長 8+N がc_ushortに収まる値）
+    __pmc_range_limit = 32760
+    # バイト数ごとの範囲読み書き用構造体（毎回生成しないようにキャッシュする）
+    __pmc_range_types = {}
+
+    @classmethod
+    def __pmc_range_type(cls, length):
+        '''指定バイト数のデータ部を持つ、IODBPMC互換の構造体クラスを返す。'''
+        if length not in cls.__pmc_range_types:
+            class IODBPMCRNG(Structure):
+                _fields_ = [
+                    ('type_a', c_short),
+                    ('type_d', c_short),
+                    ('datano_s', c_ushort),
+                    ('datano_e', c_ushort),
+                    ('cdata', c_ubyte * length)]
+            cls.__pmc_range_types[length] = IODBPMCRNG
+        return cls.__pmc_range_types[length]
+
+    @staticmethod
+    def parse_area(dev):
+        '''デバイス番号を、PMCアドレス種別と番号に分解する。
+
+        Args:
+            dev (str): デバイス番号 exp) R900 or D5600
+        Return:
+            tuple: (type_a, アドレス番号) 5=R(内部リレー), 9=D(データテーブル)
+        '''
+        if dev[0] == 'R':
+            return 5, int(dev[1:])
+        elif dev[0] == 'D':
+            return 9, int(dev[1:])
+        raise Exception('R、またはDデバイスを設定して下さい。')
+
+    def read_range(self, dev, length):
+        '''デバイスを先頭から連続したバイト列として範囲読み出しする。
+
+        プロファイルの上限バイト数を超える場合は、pmc_rdpmcrngを複数回に分けて読み出す。
+        アドレス範囲外の場合は、NCに問い合わせずにFocasDataError(EW_RANGE)を送出する。
+
+        Args:
+            dev (str): 先頭のデバイス番号 exp) R6600 or D11600
+            length (int): 読み取るバイト数
+        Return:
+            bytes: 読み出したデータ
+        '''
+        type_a, start = J3.parse_area(dev)
+        result = b''
+        with self.__lock:
+            self.__open()
+            self.__check_range(type_a, start, length, 'pmc_rdpmcrng')
+            range_max = self.__get_profile()['pmc_range_max']
+            self.__dll.pmc_rdpmcrng.restype = c_short
+            self.__dll.pmc_rdpmcrng.argtypes = (c_ushort, c_short, c_short, c_ushort, c_ushort, c_ushort, c_void_p)
+            pos = 0
+            while pos < length:
+                n = min(length - pos, range_max)
+                iodbpmc = J3.__pmc_range_type(n)()
+                res = self.__dll.pmc_rdpmcrng(
+                    self.__handle,
+                    c_short(type_a),
+                    c_short(0), # バイト型
+                    c_ushort(start + pos),
+                    c_ushort(start + pos + n - 1),
+                    8 + n,
+                    byref(iodbpmc))
+                if res != 0:
+                    self.__pmc_raise_error(res, 'pmc_rdpmcrng')
+                result += bytes(iodbpmc.cdata)
+                pos += n
+        return result
+
+    def write_range(self, dev, data):
+        '''デバイスの先頭から、連続したバイト列を範囲書き込みする。
+
+        プロファイルの上限バイト数を超える場合は、pmc_wrpmcrngを複数回に分けて書き込む。
+        アドレス範囲外の場合は、NCに問い合わせずにFocasDataError(EW_RANGE)を送出する。
+
+        Args:
+            dev (str): 先頭のデバイス番号 exp) R6600 or D11600
+            data (bytes): 書き込むデータ
+        '''
+        type_a, start = J3.parse_area(dev)
+        with self.__lock:
+            self.__open()
+            self.__check_range(type_a, start, len(data), 'pmc_wrpmcrng')
+            range_max = self.__get_profile()['pmc_range_max']
+            self.__dll.pmc_wrpmcrng.restype = c_short
+            self.__dll.pmc_wrpmcrng.argtypes = (c_ushort, c_short, c_void_p)
+            pos = 0
+            while pos < len(data):
+                n = min(len(data) - pos, range_max)
+                iodbpmc = J3.__pmc_range_type(n)()
+                iodbpmc.type_a = type_a
+                iodbpmc.type_d = 0 # バイト型
+                iodbpmc.datano_s = start + pos
+                iodbpmc.datano_e = start + pos + n - 1
+                iodbpmc.cdata[:] = data[pos:pos + n]
+                res = self.__dll.pmc_wrpmcrng(self.__handle, 8 + n, byref(iodbpmc))
+                if res != 0:
+                    self.__pmc_raise_error(res, 'pmc_wrpmcrng')
+                pos += n
+
+            if self.__cache is not None:
+                self.__cache.invalidate(type_a, start, len(data))
+
+    def __check_range(self, type_a, start, length, func):
+        '''プロファイルのアドレス範囲外なら、FocasDataError(EW_RANGE)を送出する。'''
+        area = self.__get_profile()['pmc_areas'].get('R' if type_a == 5 else 'D')
+        if area is not None and (start < area[0] or start + length - 1 > area[1]):
+            error_class, message = _PMC_ERRORS[3]
+            raise error_class(3, message, func, self.__ip + ':' + self.__port)
+
+    def read_tags(self, tags):
+        '''タグマップの全タグを、読み出し計画に従って範囲読み出しし、値を返す。
+
+        Args:
+            tags (TagMap): タグ定義 (tags.py)
+        Return:
+            dict: タグ名 -> 値
+        '''
+        with self.__lock:
+            blocks = [self.read_range(dev, length) for dev, length in tags.plan()]
+        return tags.decode(blocks)
+
+    # --- ビット操作関連 ---
+
+    def set_bits(self, dev, mask, verify=False):
+        '''マスクで指定したビットを1にする。
+
+        Args:
+            dev (str): 先頭のデバイス番号 exp) R6653
+            mask (int or bytes): 操作するビットのマスク。intの場合、下位バイトから順にdev, dev+1, ...に対応する。
+                                 exp) 0b00001001 -> R6653.0とR6653.3, 0x0100 -> R6654.0
+            verify (bool): Trueなら書き込み後に読み直し、反映されていなければ例外を送出する。
+        '''
+        self.__update_bits(dev, set_mask=mask, verify=verify)
+
+    def clear_bits(self, dev, mask, verify=False):
+        '''マスクで指定したビットを0にする。引数はset_bits()と同じ。'''
+        self.__update_bits(dev, clear_mask=mask, verify=verify)
+
+    def toggle_bits(self, dev, mask, verify=False):
+        '''マスクで指定したビットを反転する。引数はset_bits()と同じ。'''
+        self.__update_bits(dev, toggle_mask=mask, verify=verify)
+
+    def write_bits(self, dev, value, mask, verify=False):
+        '''マスクで指定したビットだけを、valueの同じ位置のビットの値にする。
+
+        Args:
+            dev (str): 先頭のデバイス番号 exp) R6653
+            value (int or bytes): 書き込む値。並びはmaskと同じ。
+            mask (int or bytes): 書き込むビットのマスク。その他の引数はset_bits()と同じ。
+        '''
+        value, mask = J3.__mask_bytes(value), J3.__mask_bytes(mask)
+        value = value.ljust(len(mask), b'\x00')
+        self.__update_bits(dev,
+            set_mask=bytes(v & m for v, m in zip(value, mask)),
+            clear_mask=bytes(~v & m for v, m in zip(value, mask)),
+            verify=verify)
+
+    def __update_bits(self, dev, set_mask=0, clear_mask=0, toggle_mask=0, verify=False):
+        '''ビットを更新する。マスクが0でないバイトが連続する範囲ごとに、範囲読み出し1回と範囲書き込み1回で行う。
+
+        読み出しから書き込みまではロックを保持するため、この接続を使う他のスレッドの書き込みと競合しない。
+        '''
+        masks = [J3.__mask_bytes(mask) for mask in (set_mask, clear_mask, toggle_mask)]
+        length = max(len(mask) for mask in masks)
+        set_mask, clear_mask, toggle_mask = [mask.ljust(length, b'\x00') for mask in masks]
+        type_a, start = J3.parse_area(dev)
+
+        with self.__lock:
+            for span_start, span_end in J3.__mask_spans(bytes(s | c | t for s, c, t in zip(set_mask, clear_mask, toggle_mask))):
+                span_dev = dev[0] + str(start + span_start)
+                current = self.read_range(span_dev, span_end - span_start)
+                data = bytes(((cur & ~clear_mask[i]) | set_mask[i]) ^ toggle_mask[i]
+                    for i, cur in zip(range(span_start, span_end), current))
+                self.write_range(span_dev, data)
+                if verify and self.read_range(span_dev, span_end - span_start) != data:
+                    raise Exception('ビットの書き込み結果が一致しません。(dev: ' + span_dev + ')')
+
+    @staticmethod
+    def __mask_bytes(mask):
+        '''マスクを、先頭アドレスから順のbytesに変換する。'''
+        if isinstance(mask, (bytes, bytearray)):
+            return bytes(mask)
+        if mask < 0:
+            raise Exception('マスクには0以上の値を設定して下さい。')
+        return mask.to_bytes(max(1, (mask.bit_length() + 7) // 8), 'little')
+
+    @staticmethod
+    def __mask_spans(mask):
+        '''マスクが0でないバイトが連続する範囲を、(開始位置, 終了位置)のリストで返す。'''
+        spans = []
+        for i, m in enumerate(mask):
+            if m == 0:
+                continue
+            if spans and spans[-1][1] == i:
+                spans[-1][1] = i + 1
+            else:
+                spans.append([i, i + 1])
+        return spans
+
+    # --- 読み出しキャッシュ関連 ---
+
+    def enable_cache(self, max_bytes=65536, default_ttl=0):
+        '''read_dev()の読み出しキャッシュを有効にする。
+
+        キャッシュはバイト単位で保持し、TTLが0より大きいアドレスのみ対象とする。
+        この接続のwrite_dev()、write_range()で書き込んだアドレスは破棄される。
+
+        Args:
+            max_bytes (int): キャッシュするバイト数の上限。超えた場合は古いものから破棄する。
+            default_ttl (float): TTLを個別に設定していないアドレスのTTL(秒)。0ならキャッシュしない。
+        '''
+        with self.__lock:
+            self.__cache = ReadCache(max_bytes, default_ttl)
+
+    def disable_cache(self):
+        '''読み出しキャッシュを無効にする。'''
+        with self.__lock:
+            self.__cache = None
+
+    def set_cache_ttl(self, dev, ttl, length=1):
+        '''アドレス範囲ごとのTTLを設定する。
+
+        キャッシュに無い場合は、この範囲全体を範囲読み出しで一度に取得する。
+
+        Args:
+            dev (str): 先頭のデバイス番号 exp) D11600
+            ttl (float): キャッシュの有効期間(秒)。0ならキャッシュしない。
+            length (int): 範囲のバイト数
+        '''
+        with self.__lock:
+            if self.__cache is None:
+                raise Exception('キャッシュが有効になっていません。enable_cache()を先に呼び出して下さい。')
+            self.__cache.set_ttl(*J3.parse_area(dev), length, ttl)
+
+    def invalidate_cache(self, dev=None, length=1):
+        '''キャッシュを破棄する。
+
+        Args:
+            dev (str): 先頭のデバイス番号。Noneなら全て破棄する。
+            length (int): 破棄するバイト数
+        '''
+        with self.__lock:
+            if self.__cache is None:
+                return
+            if dev is None:
+                self.__cache.invalidate()
+            else:
+                self.__cache.invalidate(*J3.parse_area(dev), length)
+
+    def cache_stats(self):
+        '''キャッシュのヒット・ミス数などを返す。
+
+        Return:
+            dict: exp) {'hits': 10, 'misses': 2, 'evictions': 0, 'bytes': 32}
+        '''
+        with self.__lock:
+            if self.__cache is None:
+                return {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+            return self.__cache.stats()
+
+    def __read_cache(self, dev, size):
+        '''キャッシュ経由でデバイスを読み出す。キャッシュ対象外の場合はNoneを返す。'''
+        if size not in (1, 2, 4):
+            return None
+        offset = -1
+        devno = dev
+        if dev.find('.') != -1:
+            devno = dev[0:dev.find('.')]
+            offset = int(dev[dev.find('.')+1:])
+            if offset > 7 or 0 > offset:
+                return None
+        type_a, addr = J3.parse_area(devno)
+        if dev[0] == 'R' or offset != -1:
+            size = 1
+
+        span = self.__cache.span(type_a, addr, size)
+        if span is None:
+            return None
+        data = self.__cache.get(type_a, addr, size)
+        if data is None:
+            # キャッシュに無い場合は、TTLを設定した範囲全体をまとめて読み出す
+            start, length = span
+            fetched = self.read_range(dev[0] + str(start), length)
+            self.__cache.put(type_a, start, fetched)
+            data = fetched[addr - start:addr - start + size]
+
+        # read_dev()と同じ形式で値を返す
+        if offset != -1:
+            return 1 if data[0] & self.__offset_dict[offset] != 0 else 0
+        elif size == 1:
+            return data[0]
+        return int.from_bytes(data, 'little', signed=True)
+
+    # ホストごとの非同期書き込みキュー
+    __write_queues = {}
+
+    @classmethod
+    def get_write_queue(cls, host, interval=0.05):
+        '''ホストごとの非同期書き込みキューを返す。存在しない場合は作成する。
+
+        Args:
+            host: IPアドレス:ポート番号
+            interval (float): 自動で書き込みを行う周期(秒)
+        Return:
+            WriteQueue: 書き込みキュー
+        '''
+        with cls.__lock:
+            if host not in cls.__write_queues or cls.__write_queues[host].is_closed():
+                cls.__write_queues[host] = WriteQueue(host, interval)
+            return cls.__write_queues[host]
 
     # --- エラー出力関連 ---
 
-    def __cnc_raise_error(self, errcd):
-        '''エラーコードから、エラーの内容をExceptionとして返す。
+    def __cnc_raise_error(self, errcd, func=None):
+        '''エラーコードから、エラーの内容を例外として送出する。
         エラーがない場合（errcd=0）は何もしない。
 
         Raises:
-            Exception: エラーメッセージ
-        '''
-        __cnc_errmap = {
-            -17 : '[EW_PROTOCOL] イーサネットボードからのデータが間違っています。',
-            -16 : '[EW_SOCKET] CNCの電源、イーサネットケーブル、I/Fボードを調べてください。',
-            -15 : '[EW_NODLL] 指定されたノードに対応する各CNCシリーズのDLLファイルがありません。',
-            -8 : '[EW_HANDLE] ハンドル番号の誤り。正常なライブラリハンドル番号を取得する。',
-            -7 : '[EW_VERSION] CNC/PMCのバージョンは、ライブラリのものと一致しません。',
-            -6 : '[EW_UNEXP] 異常な状態のライブラリ。予期しないエラーが発生しました。',
-            -2 : '[EW_RESET] RESETまたはSTOPボタンが押されました。',
-            -1 : '[EW_BUSY] CNC処理が完了するまで待つか、再試行してください。',
-            0 : '[EW_OK] 正常終了。',
-            1 : '[EW_FUNC] 関数が実行されていない、または利用できません。',
-            2 : '[EW_LENGTH] データブロック長の誤り、データの数のエラー',
-            3 : '[EW_NUMBER] データ番号の誤り',
-            4 : '[EW_ATTRIB] データ属性の誤り',
-            5 : '[EW_DATA] 指定されたプログラムが見つかりません。',
-            6 : '[EW_NOOPT] 該当するCNCオプションがありません。',
-            7 : '[EW_PROT] 書き込み動作が禁止されています。',
-            8 : '[EW_OVRFLOW] CNCテープメモリがオーバーフローしています。',
-            9 : '[EW_PARAM] CNCパラメータが正しく設定されていません。',
-            10 : '[EW_BUFFER] バッファが空またはいっぱいです。CNC処理が完了するまで待つか、再試行してください。',
-            11 : '[EW_PATH] パス番号が正しくありません。',
-            12 : '[EW_MODE] CNCモードが正しくありません。',
-            13 : '[EW_REJECT] CNCの実行が拒否されます。実行の状態を確認してください。',
-            14 : '[EW_DTSRVR] 一部のエラーは、データ・サーバで発生します。',
-            15 : '[EW_ALARM] CNCのアラームにより機能を実行できません。アラームの原因を取り除いてください。',
-            16 : '[EW_STOP] CNCのステータスが停止または緊急事態です。',
-            17 : '[EW_PASSWD] CNCデータ保護機能によって保護されています。'}
-
+            FocasError: エラーコードに対応するサブクラス
+        '''
         # EW_OK：正常
         if errcd == 0:
             return
         # EW_SOCKET：無効となったライブラリハンドルでライブラリ関数を実行すると、完了ステータスがEW_SOCKETに
         elif errcd == -16:
-            self.close()
-        raise Exception('Error (errcd: ' + str(errcd) + ') ' + __cnc_errmap.get(errcd, 'Unkown error'))
+            self.__discard_handle()
+        error_class, message = _CNC_ERRORS.get(errcd, (FocasError, 'Unkown error'))
+        raise error_class(errcd, message, func, self.__ip + ':' + self.__port)
 
-    def __pmc_raise_error(self, errcd):
-        '''エラーコードから、エラーの内容をExceptionとして返す。
+    def __pmc_raise_error(self, errcd, func=None):
+        '''エラーコードから、エラーの内容を例外として送出する。
         エラーがない場合（errcd=0）は何もしない。
 
-        ToDo: エラーコード-16と-17はのイーサネットのエラーは、更に詳細なエラーを表示可能。
-              必要であれば今後取得するようにする。
-              詳細は、https://www.inventcom.net/fanuc-focas-library/General/errcode
-
         Raises:
-            Exception: エラーメッセージ
-        '''
-        __pmc_errmap = {
-            -17 : '[EW_PROTOCOL] イーサネットボードからのデータが間違っています。',
-            -16 : '[EW_SOCKET] CNCの電源、イーサネットケーブル、I/Fボードを調べてください。',
-            -15 : '[EW_NODLL] 指定されたノードに対応する各CNCシリーズのDLLファイルがありません。',
-            -8 : '[EW_HANDLE] ハンドル番号の誤り。正常なライブラリハンドル番号を取得する。',
-            -7 : '[EW_VERSION] CNC/PMCのバージョンは、ライブラリのものと一致しません。',
-            -6 : '[EW_UNEXP] 異常な状態のライブラリ。予期しないエラーが発生しました。',
-            0 : '[EW_OK] 正常終了。',
-            1 : '[EW_NOPMC] PMCは存在しません。',
-            2 : '[EW_LENGTH] データブロック長の誤り',
-            3 : '[EW_RANGE] アドレス範囲エラー',
-            4 : '[EW_TYPE] アドレス型/データ型エラー',
-            5 : '[EW_DATA] データエラー',
-            6 : '[EW_NOOPT] 該当するCNCオプションはありません。',
-            10 : '[EW_BUFFER] バッファが空またはいっぱいです。PMC処理が完了するまで待つか、再試行してください。',
-            17 : '[EW_PASSWD] データは、CNCデータ保護機能によって保護されています。'}
-
+            FocasError: エラーコードに対応するサブクラス
+        '''
         # EW_OK：正常
         if errcd == 0:
             return
-        raise Exception('Error (errcd: ' + str(errcd) + ') ' + __pmc_errmap.get(errcd, 'Unkown error'))
+        error_class, message = _PMC_ERRORS.get(errcd, (FocasError, 'Unkown error'))
+        raise error_class(errcd, message, func, self.__ip + ':' + self.__port)
+
+    def __cnc_data_error(self, func, details):
+        '''EW_DATA(5)の詳細エラー番号を取得し、送出するFocasDataErrorを返す。
+
+        Args:
+            func (str): EW_DATAを返した関数名
+            details (dict): 詳細エラー番号 -> メッセージ
+        '''
+        detail_err = self.__cnc_getdtailerr()
+        message = '[EW_DATA] ' + details.get(detail_err, '詳細エラー番号: ' + str(detail_err))
+        return FocasDataError(5, message, func, self.__ip + ':' + self.__port, detail_err)
+
+    def __discard_handle(self):
+        '''無効になったライブラリハンドルを解放し、閉じた状態にする。解放の結果は確認しない。'''
+        self.__dll.cnc_freelibhndl.restype = c_short
+        self.__dll.cnc_freelibhndl.argtypes = (c_ushort,)
+        self.__dll.cnc_freelibhndl(self.__handle)
+        self.__isopen = False
 
     def __cnc_getdtailerr(self):
         '''CNC関数実行時に、発生したエラーの詳細情報を取得する為のステータス番号を返す。
@@ -706,7 +1504,7 @@ class J3:
         self.__dll.cnc_getdtailerr.restype = c_short
         self.__dll.cnc_getdtailerr.argtypes = (c_ushort, POINTER(ODBERR))
         res = self.__dll.cnc_getdtailerr(self.__handle, byref(odberr))
-        self.__cnc_raise_error(res)
+        self.__cnc_raise_error(res, 'cnc_getdtailerr')
         return odberr.err_no
 
     def __pmc_getdtailerr(self):
@@ -725,5 +1523,500 @@ class J3:
         self.__dll.pmc_getdtailerr.restype = c_short
         self.__dll.pmc_getdtailerr.argtypes = (c_ushort, POINTER(ODBPMCERR))
         res = self.__dll.pmc_getdtailerr(self.__handle, byref(odberr))
-        self.__pmc_raise_error(res)
+        self.__pmc_raise_error(res, 'pmc_getdtailerr')
         return odberr.err_no
+
+
+class WriteQueue:
+    '''デバイスへの書き込みを溜めておき、まとめて書き込むキュー。
+
+    同じアドレスへの書き込みは最後の値だけが残り、連続したアドレスは
+    pmc_wrpmcrngの範囲書き込み1回にまとめる。
+    書き込みは一定周期、またはflush()の呼び出し時に行う。
+    J3.get_write_queue()から取得して使う。
+    '''
+
+    def __init__(self, host, interval=0.05):
+        '''
+        Args:
+            host: IPアドレス:ポート番号
+            interval (float): 自動で書き込みを行う周期(秒)
+        '''
+        self.__host = host
+        self.__interval = interval
+        # (type_a, アドレス番号) -> [値, 書き込むビットのマスク, Futureのリスト]
+        self.__pending = {}
+        self.__pending_lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__closed = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def write(self, dev, in_data, size=1):
+        '''デバイス書き込みをキューに追加する。引数はJ3.write_dev()と同じ。
+
+        Args:
+            dev (str): デバイス番号 exp) R900 or R900.1 or D5600
+            in_data (int): 書き込む値。オフセット有りの場合は、0or1(1bit)。
+            size (int): 書き込むデータのサイズ(byte) exp) 1 or 2 or 4
+        Return:
+            Future: 書き込み完了時に結果が設定される。失敗時は例外が設定される。
+                    他の書き込みと値をまとめるため、cancel()はできない（Falseを返す）。
+        '''
+        if self.__closed.is_set():
+            raise Exception('書き込みキューは既に閉じられています。')
+
+        # オフセット有りの場合、対象ビットだけをマスクで書き込む
+        if dev.find('.') != -1:
+            if not (in_data == 1 or in_data == 0):
+                raise Exception('書き込むデータの値が不正です。オフセット有りの場合、0 or 1で指定してください。')
+            offset = int(dev[dev.find('.')+1:])
+            if offset > 7 or 0 > offset:
+                raise Exception('書き込むデバイスのオフセット値が不正です。0~7の範囲内で指定してください。')
+            type_a, addr = J3.parse_area(dev[0:dev.find('.')])
+            items = [(addr, in_data << offset, 1 << offset)]
+        # オフセット無し
+        else:
+            if size not in (1, 2, 4):
+                raise Exception('サイズは、1(byte) or 2(byte) or 4(byte)のどれかを設定して下さい。')
+            type_a, addr = J3.parse_area(dev)
+            data = in_data.to_bytes(size, 'little', signed=in_data < 0)
+            items = [(addr + i, b, 0xFF) for i, b in enumerate(data)]
+
+        future = Future()
+        # 実行中にしておき、cancel()で取り消せない書き込みが取り消されたように見えないようにする
+        future.set_running_or_notify_cancel()
+        with self.__pending_lock:
+            for addr, value, mask in items:
+                entry = self.__pending.setdefault((type_a, addr), [0, 0, []])
+                entry[0] = (entry[0] & ~mask) | (value & mask)
+                entry[1] |= mask
+                entry[2].append(future)
+        return future
+
+    def flush(self):
+        '''キュー内の書き込みを、呼び出し元のスレッドで直ちに実行する。'''
+        with self.__flush_lock:
+            with self.__pending_lock:
+                pending = self.__pending
+                self.__pending = {}
+            if not pending:
+                return
+
+            j3 = J3.get_connection(self.__host)
+            errors = {}
+            for type_a, start, entries in WriteQueue.__spans(pending):
+                dev = ('R' if type_a == 5 else 'D') + str(start)
+                try:
+                    # 一部のビットだけを書き込むアドレスがある場合は、ロックを保持したまま現在値を読み込んで合成する
+                    if any(mask != 0xFF for _, mask, _ in entries):
+                        j3.write_bits(dev, bytes(value for value, _, _ in entries), bytes(mask for _, mask, _ in entries))
+                    else:
+                        j3.write_range(dev, bytes(value for value, _, _ in entries))
+                except Exception as e:
+                    for _, _, futures in entries:
+                        for future in futures:
+                            errors[future] = e
+
+            # 1つの書き込みが複数の範囲にまたがる場合は、全て成功した時のみ完了とする
+            done = set()
+            for _, _, futures in pending.values():
+                for future in futures:
+                    if future in done:
+                        continue
+                    done.add(future)
+                    if future in errors:
+                        future.set_exception(errors[future])
+                    else:
+                        future.set_result(None)
+
+    def close(self):
+        '''残りの書き込みを実行し、キューを閉じる。'''
+        self.__closed.set()
+        self.__thread.join()
+        self.flush()
+
+    def is_closed(self):
+        '''キューが閉じられていればTrue'''
+        return self.__closed.is_set()
+
+    @staticmethod
+    def __spans(pending):
+        '''書き込み対象を、連続したアドレスごとの範囲にまとめる。
+
+        Return:
+            list: (type_a, 先頭アドレス番号, [[値, マスク, Futureのリスト], ...])のリスト
+        '''
+        spans = []
+        for type_a, addr in sorted(pending):
+            if spans and spans[-1][0] == type_a and spans[-1][1] + len(spans[-1][2]) == addr:
+                spans[-1][2].append(pending[(type_a, addr)])
+            else:
+                spans.append((type_a, addr, [pending[(type_a, addr)]]))
+        return spans
+
+    def __run(self):
+        while not self.__closed.wait(self.__interval):
+            try:
+                self.flush()
+            except:
+                traceback.print_exc()
+
+
+class ReadCache:
+    '''J3.read_dev()用の、バイト単位の読み出しキャッシュ。
+
+    アドレスごとに有効期限を持ち、上限バイト数を超えた場合は最も古く参照されたものから破棄する。
+    J3.enable_cache()で有効にして使う。
+    '''
+
+    def __init__(self, max_bytes=65536, default_ttl=0):
+        '''
+        Args:
+            max_bytes (int): キャッシュするバイト数の上限
+            default_ttl (float): TTLを個別に設定していないアドレスのTTL(秒)
+        '''
+        self.__max_bytes = max_bytes
+        self.__default_ttl = default_ttl
+        # (type_a, アドレス番号) -> (TTL, 範囲の先頭アドレス番号, 範囲のバイト数)
+        self.__ttl = {}
+        # (type_a, アドレス番号) -> (有効期限, 値)
+        self.__data = OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def set_ttl(self, type_a, start, length, ttl):
+        '''アドレス範囲のTTLを設定する。'''
+        for addr in range(start, start + length):
+            self.__ttl[(type_a, addr)] = (ttl, start, length)
+        self.invalidate(type_a, start, length)
+
+    def span(self, type_a, addr, size):
+        '''キャッシュ対象なら、まとめて読み出すべき範囲を(先頭アドレス番号, バイト数)で返す。対象外ならNone。
+
+        読み出すアドレスがTTLを設定した範囲からはみ出す場合は、範囲外の分をキャッシュできないため対象外とする。
+        '''
+        ttl, start, length = self.__ttl.get((type_a, addr), (self.__default_ttl, addr, size))
+        if ttl <= 0 or addr + size > start + length:
+            return None
+        return start, length
+
+    def get(self, type_a, addr, size):
+        '''有効期限内の値が全て揃っていればbytesを返す。1つでも無ければNone。'''
+        now = time.monotonic()
+        result = bytearray()
+        for key in ((type_a, a) for a in range(addr, addr + size)):
+            entry = self.__data.get(key)
+            if entry is None or entry[0] < now:
+                self.__misses += 1
+                return None
+            self.__data.move_to_end(key)
+            result.append(entry[1])
+        self.__hits += 1
+        return bytes(result)
+
+    def put(self, type_a, start, data):
+        '''読み出したデータを、アドレスごとのTTLでキャッシュに格納する。'''
+        now = time.monotonic()
+        for i, value in enumerate(data):
+            key = (type_a, start + i)
+            ttl = self.__ttl.get(key, (self.__default_ttl,))[0]
+            if ttl <= 0:
+                continue
+            self.__data[key] = (now + ttl, value)
+            self.__data.move_to_end(key)
+        while len(self.__data) > self.__max_bytes:
+            self.__data.popitem(last=False)
+            self.__evictions += 1
+
+    def invalidate(self, type_a=None, start=0, length=0):
+        '''キャッシュを破棄する。type_aがNoneなら全て破棄する。'''
+        if type_a is None:
+            self.__data.clear()
+            return
+        for addr in range(start, start + length):
+            self.__data.pop((type_a, addr), None)
+
+    def stats(self):
+        '''ヒット・ミス数、破棄数、保持しているバイト数を返す。'''
+        return {
+            'hits': self.__hits,
+            'misses': self.__misses,
+            'evictions': self.__evictions,
+            'bytes': len(self.__data)}
+
+
+class TransferCancelled(Exception):
+    '''TransferJob.cancel()により転送が中止された。'''
+
+
+class TransferJob:
+    '''NCプログラムの読み込み・書き込みを、バックグラウンドで行う転送ジョブ。
+
+    J3.start_read_file()、J3.start_write_file()から取得して使う。
+    '''
+
+    def __init__(self, host, path, data=None, out_path=None, retries=3, retry_wait=1.0):
+        '''
+        Args:
+            host: IPアドレス:ポート番号
+            path (str): 絶対パス
+            data (bytes): 書き込むデータ。Noneなら読み込み。
+            out_path (str): 読み込んだプログラムを保存するローカルのパス
+            retries (int): 失敗時に再試行する回数
+            retry_wait (float): 再試行までの待ち時間(秒)
+        '''
+        self.__host = host
+        self.__path = path
+        self.__data = data
+        self.__out_path = out_path
+        self.__retries = retries
+        self.__retry_wait = retry_wait
+        self.__bytes = 0
+        self.__total = None
+        self.__attempts = 0
+        self.__state = 'running'
+        self.__started = time.monotonic()
+        self.__finished = None
+        self.__cancel = threading.Event()
+        self.__cancel_lock = threading.Lock()
+        self.__cancellable = True
+        self.__j3 = None
+        self.__future = Future()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def progress(self):
+        '''転送の進捗を返す。
+
+        Return:
+            dict: exp) {'state': 'running', 'bytes': 2048, 'total': 4096, 'percent': 50.0,
+                        'bytes_per_sec': 10240.0, 'retries': 0}
+                  stateは'running', 'done', 'cancelled', 'failed'のどれか。
+                  全体のバイト数が分からない場合、totalとpercentはNone。
+        '''
+        elapsed = (self.__finished or time.monotonic()) - self.__started
+        total = self.__total
+        percent = None
+        if total:
+            percent = 100.0 if self.__state == 'done' else min(100.0, self.__bytes * 100.0 / total)
+        return {
+            'state': self.__state,
+            'bytes': self.__bytes,
+            'total': total,
+            'percent': percent,
+            'bytes_per_sec': self.__bytes / elapsed if elapsed > 0 else 0.0,
+            'retries': self.__attempts}
+
+    def cancel(self):
+        '''転送を中止する。送受信の区切りで転送を終了し、result()はTransferCancelledを送出する。
+
+        書き込みは既存のプログラムを削除してから行うため、書き込みを始めた後は中止しない（途中で止めるとプログラムが無くなる）。
+
+        Return:
+            bool: 中止できる場合はTrue。書き込みを始めた後や、転送が終了した後はFalse
+        '''
+        with self.__cancel_lock:
+            if not self.__cancellable:
+                return False
+            self.__cancel.set()
+            return True
+
+    def done(self):
+        '''転送が終了していればTrue'''
+        return self.__future.done()
+
+    def result(self, timeout=None):
+        '''転送の終了を待ち、結果を返す。
+
+        Args:
+            timeout (float): 待つ秒数。Noneなら終了まで待つ。
+        Return:
+            bytes: 読み込みの場合はプログラムの中身。書き込みの場合はNone。
+        '''
+        return self.__future.result(timeout)
+
+    def __run(self):
+        self.__j3 = J3(self.__host)
+        try:
+            if self.__data is None:
+                result = self.__read()
+            else:
+                result = self.__write()
+            state = 'done'
+        except TransferCancelled as e:
+            state, error = 'cancelled', e
+        except Exception as e:
+            state, error = 'failed', e
+        with self.__cancel_lock:
+            self.__cancellable = False
+        # 転送を終了して接続を閉じてから、結果を設定する
+        try:
+            self.__j3.close()
+        except Exception:
+            pass
+        self.__state = state
+        self.__finished = time.monotonic()
+        if state == 'done':
+            self.__future.set_result(result)
+        else:
+            self.__future.set_exception(error)
+
+    def __read(self):
+        # 全体のサイズはフォルダの一覧から取得する（取得できなくても転送は行う）
+        try:
+            name = self.__path.split('/')[-1]
+            for info in self.__j3.find_dir(self.__path[:self.__path.rfind('/') + 1]):
+                if normalize_name(info['name']) == normalize_name(name):
+                    self.__total = int(info['size'])
+        except Exception:
+            pass
+
+        received = bytearray()
+        while True:
+            # 再試行時は、受信済みの分を読み飛ばす
+            skip = len(received)
+            chunks = self.__j3.iter_file(self.__path)
+            try:
+                for chunk in chunks:
+                    self.__check_cancel()
+                    if skip:
+                        n = min(skip, len(chunk))
+                        chunk = chunk[n:]
+                        skip -= n
+                    received += chunk
+                    self.__bytes = len(received)
+                break
+            except TransferCancelled:
+                raise
+            except Exception:
+                self.__retry()
+            finally:
+                chunks.close()
+
+        if self.__out_path is not None:
+            with open(self.__out_path, 'wb') as f:
+                f.write(received)
+        return bytes(received)
+
+    def __write(self):
+        # 既存のプログラムを削除した後に中止すると、プログラムが無くなるため、ここから先は中止を受け付けない
+        with self.__cancel_lock:
+            self.__check_cancel()
+            self.__cancellable = False
+        while True:
+            try:
+                self.__j3.write_file(self.__path, self.__data, progress=self.__on_progress)
+                return None
+            except TransferCancelled:
+                raise
+            except Exception:
+                self.__retry()
+
+    def __on_progress(self, sent, total):
+        self.__bytes = sent
+        self.__total = total
+
+    def __check_cancel(self):
+        if self.__cancel.is_set():
+            raise TransferCancelled('転送は中止されました。(path: ' + self.__path + ')')
+
+    def __retry(self):
+        '''再試行で回復するエラーで、再試行回数が残っていれば、待ってから新しい接続に切り替える。
+        それ以外は元の例外を送出する。
+        '''
+        if self.__attempts >= self.__retries or not getattr(sys.exc_info()[1], 'retryable', False):
+            raise
+        self.__attempts += 1
+        try:
+            self.__j3.close()
+        except Exception:
+            pass
+        if self.__cancel.wait(self.__retry_wait):
+            self.__check_cancel()
+        self.__j3 = J3(self.__host)
+
+
+class _FileSaver:
+    '''J3.read_files()で読み込んだプログラムを、別スレッドでローカルに保存する。'''
+
+    def __init__(self, out_dir):
+        makedirs(out_dir, exist_ok=True)
+        self.__out_dir = out_dir
+        self.__queue = queue.Queue()
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def put(self, name, data):
+        '''保存するプログラムを追加する。'''
+        if self.__error is not None:
+            raise self.__error
+        self.__queue.put((name, data))
+
+    def close(self):
+        '''保存の完了を待つ。保存中にエラーがあれば例外を送出する。'''
+        self.__queue.put(None)
+        self.__thread.join()
+        if self.__error is not None:
+            raise self.__error
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            if self.__error is not None:
+                continue
+            try:
+                with open(path.join(self.__out_dir, item[0]), 'wb') as f:
+                    f.write(item[1])
+            except Exception as e:
+                self.__error = e
+
+
+class _FileLoader:
+    '''J3.write_files()で書き込むデータを、別スレッドで先読みする。'''
+
+    def __init__(self, items, prefetch=4):
+        '''
+        Args:
+            items (list): 書き込むデータ(bytes)、またはローカルファイルのパス(str)のリスト
+            prefetch (int): 先読みする数
+        '''
+        self.__items = items
+        self.__queue = queue.Queue(prefetch)
+        self.__closed = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def get(self):
+        '''次のデータを返す。読み込みに失敗していれば例外を送出する。'''
+        data, error = self.__queue.get()
+        if error is not None:
+            raise error
+        return data
+
+    def close(self):
+        '''先読みを中止する。'''
+        self.__closed.set()
+        while self.__thread.is_alive():
+            try:
+                self.__queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.__thread.join()
+
+    def __run(self):
+        for item in self.__items:
+            if self.__closed.is_set():
+                return
+            try:
+                if isinstance(item, str):
+                    with open(item, 'rb') as f:
+                        item = f.read()
+                self.__queue.put((item, None))
+            except Exception as e:
+                self.__queue.put((None, e))
+                return
@@ -0,0 +1,453 @@
+# coding: utf-8
+'''
+NCプログラムの解析と、加工プログラムライブラリのインデックス
+
+read_file()/iter_file()の結果やローカルファイルを、受信したデータごとに順に解析して
+プログラム番号・コメント・工具(T/M6)・サブプログラム呼び出し(M98 P)・ブロック数を取り出す。
+ProgramIndexは解析結果をJSONに保存し、変更されたファイルだけを解析し直す。
+サブプログラムを含めた転送や、数千本のプログラムからの検索をインデックスだけで行える。
+
+インデックスの形式:
+    {"version": 1, "programs": {キー: {"name", "comment", "comments", "tools", "tool_changes",
+                                       "calls", "blocks", "size", "hash", "stamp"}}}
+    キーはローカルファイルのパス、またはNC内の絶対パス(//CNC_MEM/USER/LIBRARY/O0100)
+'''
+import fnmatch
+import hashlib
+import json
+import os
+import re
+
+from util import write_atomic
+
+
+# コメント、プログラム名(<NAME>)、アドレスと数値の組(G01, X-1.5)
+_TOKEN = re.compile(rb'\(([^)]*)\)?|<([^>]*)>?|([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+))?')
+
+# P指定でプログラムを呼び出すMコード、Gコード
+_CALL_M = ('98', '198')
+_CALL_G = ('65', '66', '66.1')
+
+
+def tokenize(chunks):
+    '''NCプログラムを1ブロックずつ解析するジェネレーター。
+
+    ブロックは改行で区切り、'%'だけの行と空行は返さない。
+    ブロックの途中でデータが分割されていてもよい。
+
+    Args:
+        chunks: bytesのイテラブル（iter_file()の結果など）、またはbytes
+    Return:
+        generator: ブロックごとのトークンのリスト
+                   exp) [('N', '10'), ('G', '01'), ('X', '-1.5'), ('(', 'ROUGH'), ('<', 'SUB1')]
+                   '('はコメント、'<'はプログラム名。マクロ式などで数値が無いアドレスの値はNone
+    '''
+    if isinstance(chunks, (bytes, bytearray)):
+        chunks = (chunks,)
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        # 最後の行は次のデータに続いている可能性がある
+        rest = lines.pop()
+        for line in lines:
+            block = _tokenize_line(line)
+            if block:
+                yield block
+    block = _tokenize_line(rest)
+    if block:
+        yield block
+
+
+def _tokenize_line(line):
+    '''1行分のbytesをトークンのリストにする。'''
+    block = []
+    for match in _TOKEN.finditer(line.strip(b'\r% \t')):
+        comment, name, address, value = match.groups()
+        if address is not None:
+            block.append((address.upper().decode('ascii'), value.decode('ascii') if value else None))
+        elif comment is not None:
+            block.append(('(', comment.decode('utf-8', 'replace').strip()))
+        else:
+            block.append(('<', name.decode('utf-8', 'replace').strip()))
+    return block
+
+
+def program_name(value):
+    '''O番号の数値を、プログラム名に変換する。 exp) '100' -> 'O0100' '''
+    return 'O%04d' % int(float(value))
+
+
+def normalize_name(name):
+    '''find_dir()やパスのプログラム名を、O番号のプログラム名にそろえる。O番号以外の名前はそのまま返す。
+
+    NCによってはfind_dir()の名前に'O'が付かないため、パスを組み立てる前や比較する前に使う。
+    exp) '100' -> 'O0100', 'O100' -> 'O0100', 'MAIN_A' -> 'MAIN_A'
+    '''
+    if name.isdigit():
+        return program_name(name)
+    if name[0:1] == 'O' and name[1:].isdigit():
+        return program_name(name[1:])
+    return name
+
+
+def strip_tape(data):
+    '''ファイルの'%'の行とCRを取り除き、read_file()/write_file()と同じ形式にする。
+
+    exp) b'%\r\nO0100\r\nM30\r\n%\r\n' -> b'O0100\nM30'
+
+    Args:
+        data (bytes): ファイルの中身
+    Return:
+        bytes: プログラムの中身。2つ目の'%'以降は取り除く
+    '''
+    data = data.replace(b'\r', b'').lstrip(b'\n')
+    if data.startswith(b'%'):
+        data = data.split(b'\n', 1)[1] if b'\n' in data else b''
+    end = data.find(b'\n%')
+    if end != -1:
+        data = data[:end]
+    return data.rstrip(b'\n')
+
+
+def scan(chunks):
+    '''NCプログラムを解析し、インデックスの1件分の情報を返す。
+
+    サブプログラム呼び出しは、M98/M198/G65/G66のP指定と<NAME>指定を対象にする。
+    Pが5桁以上の場合は、下4桁をプログラム番号、上の桁を繰り返し回数とみなす。
+
+    Args:
+        chunks: bytesのイテラブル（iter_file()の結果など）、またはbytes
+    Return:
+        dict: {'name': プログラム名（最初のブロックがO番号か<NAME>で始まらなければNone）, 'comment': プログラム名の行のコメント, 'comments': 全コメント,
+               'tools': 工具番号のリスト, 'tool_changes': M6の回数, 'calls': 呼び出すプログラム名のリスト,
+               'blocks': ブロック数, 'size': バイト数, 'hash': sha256}
+    '''
+    if isinstance(chunks, (bytes, bytearray)):
+        chunks = (chunks,)
+    sha = hashlib.sha256()
+    counter = {'size': 0}
+
+    def feed():
+        for chunk in chunks:
+            sha.update(chunk)
+            counter['size'] += len(chunk)
+            yield chunk
+
+    info = {'name': None, 'comment': '', 'comments': [], 'tools': [], 'tool_changes': 0, 'calls': [], 'blocks': 0}
+    tools = set()
+    calls = []
+    for block in tokenize(feed()):
+        info['blocks'] += 1
+        codes = {}
+        for address, value in block:
+            if address == '(':
+                info['comments'].append(value)
+            elif value is not None:
+                codes.setdefault(address, []).append(value)
+
+        # プログラム名は最初のブロックの先頭のO番号、または<NAME>。無ければNoneのまま
+        if info['blocks'] == 1:
+            address, value = block[0]
+            if address == 'O' and value is not None:
+                info['name'] = program_name(value)
+            elif address == '<':
+                info['name'] = value
+            if info['name'] is not None:
+                info['comment'] = ' '.join(value for address, value in block if address == '(')
+
+        for value in codes.get('T', ()):
+            tools.add(int(float(value)))
+        m_codes = [value.lstrip('0') for value in codes.get('M', ())]
+        if '6' in m_codes:
+            info['tool_changes'] += 1
+
+        g_codes = [value.lstrip('0') or '0' for value in codes.get('G', ())]
+        if any(code in _CALL_M for code in m_codes) or any(code in _CALL_G for code in g_codes):
+            if 'P' in codes:
+                digits = codes['P'][0].split('.')[0].lstrip('+')
+                calls.append(program_name(digits[-4:] if len(digits) > 4 else digits))
+            else:
+                calls.extend(value for address, value in block if address == '<')
+
+    info['tools'] = sorted(tools)
+    info['calls'] = list(dict.fromkeys(name for name in calls if name != info['name']))
+    info['size'] = counter['size']
+    info['hash'] = sha.hexdigest()
+    return info
+
+
+def scan_file(file_path, chunk_size=65536):
+    '''ローカルファイルを少しずつ読み込んで解析する。
+
+    Args:
+        file_path (str): ファイルのパス
+        chunk_size (int): 1回に読み込むバイト数
+    Return:
+        dict: scan()の結果
+    '''
+    with open(file_path, 'rb') as f:
+        return scan(iter(lambda: f.read(chunk_size), b''))
+
+
+class ProgramIndex:
+    '''加工プログラムの解析結果を保存するインデックス。'''
+
+    def __init__(self, index_path):
+        '''
+        Args:
+            index_path (str): インデックスのJSONファイルのパス。存在すれば読み込む。
+        '''
+        self.__index_path = index_path
+        self.__programs = {}
+        self.__lookup = None
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                self.__programs = json.load(f)['programs']
+
+    def __len__(self):
+        return len(self.__programs)
+
+    def keys(self):
+        '''登録されているキーのリストを返す。'''
+        return sorted(self.__programs)
+
+    def get(self, key):
+        '''キーの解析結果を返す。登録されていなければNone'''
+        return self.__programs.get(key)
+
+    def add(self, key, chunks, stamp=None):
+        '''プログラムを解析して登録する。
+
+        Args:
+            key (str): キー（ローカルファイルのパス、またはNC内の絶対パス）
+            chunks: bytesのイテラブル、またはbytes
+            stamp (list): 変更の判定に使う値（サイズ・更新日時など）
+        Return:
+            dict: 解析結果
+        '''
+        entry = scan(chunks)
+        if entry['name'] is None:
+            # プログラム名の無いファイルは、ファイル名をプログラム名にする
+            entry['name'] = ProgramIndex.__basename(key)
+        entry['stamp'] = stamp
+        self.__programs[key] = entry
+        self.__lookup = None
+        return entry
+
+    def remove(self, key):
+        '''キーを削除する。'''
+        if self.__programs.pop(key, None) is not None:
+            self.__lookup = None
+
+    def save(self):
+        '''インデックスをファイルに保存する。'''
+        write_atomic(self.__index_path, json.dumps({'version': 1, 'programs': self.__programs}, ensure_ascii=False).encode('utf-8'))
+
+    # --- 差分更新 ---
+
+    def update_dir(self, directory, patterns=None):
+        '''ローカルフォルダのプログラムを登録し、インデックスを保存する。
+
+        サイズと更新日時が前回と同じファイルは解析しない。削除されたファイルはインデックスからも削除する。
+
+        Args:
+            directory (str): フォルダのパス。サブフォルダも対象にする。
+            patterns (list): 対象にするファイル名のパターン exp) ['O*', '*.nc']。Noneなら全て
+        Return:
+            dict: {'total': 本数, 'scanned': 解析した本数, 'removed': 削除した本数}
+        '''
+        directory = os.path.abspath(directory)
+        index_path = os.path.abspath(self.__index_path)
+        found = set()
+        scanned = 0
+        for root, _, names in os.walk(directory):
+            for name in names:
+                file_path = os.path.join(root, name)
+                if file_path in (index_path, index_path + '.tmp'):
+                    continue
+                if patterns is not None and not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                    continue
+                found.add(file_path)
+                stat = os.stat(file_path)
+                stamp = [stat.st_size, stat.st_mtime_ns]
+                entry = self.__programs.get(file_path)
+                if entry is None or entry['stamp'] != stamp:
+                    with open(file_path, 'rb') as f:
+                        self.add(file_path, iter(lambda: f.read(65536), b''), stamp)
+                    scanned += 1
+
+        prefix = os.path.join(directory, '')
+        removed = [key for key in self.__programs if key.startswith(prefix) and key not in found]
+        for key in removed:
+            self.remove(key)
+        self.save()
+        return {'total': len(found), 'scanned': scanned, 'removed': len(removed)}
+
+    def update_nc(self, j3, folders=('//CNC_MEM/USER/LIBRARY/',)):
+        '''NC内のプログラムを登録し、インデックスを保存する。
+
+        find_dir()のサイズ・更新日時が前回と同じプログラムは読み込まない。
+        読み込むプログラムは、iter_file()で受信したデータごとに解析する。
+
+        Args:
+            j3 (J3): 接続
+            folders (list): フォルダ。サブフォルダも対象にする。
+        Return:
+            dict: {'total': 本数, 'scanned': 解析した本数, 'removed': 削除した本数}
+        '''
+        found = set()
+        scanned = 0
+        pending = list(folders)
+        while pending:
+            folder = pending.pop(0)
+            for info in j3.find_dir(folder):
+                if info['type'] == 'folder':
+                    pending.append(folder + info['name'] + '/')
+                    continue
+                key = folder + normalize_name(info['name'])
+                found.add(key)
+                stamp = [info['size'], info.get('date', '')]
+                entry = self.__programs.get(key)
+                if entry is None or entry['stamp'] != stamp:
+                    self.add(key, j3.iter_file(key), stamp)
+                    scanned += 1
+
+        removed = [key for key in self.__programs
+            if any(key.startswith(folder) for folder in folders) and key not in found]
+        for key in removed:
+            self.remove(key)
+        self.save()
+        return {'total': len(found), 'scanned': scanned, 'removed': len(removed)}
+
+    # --- 検索 ---
+
+    def find(self, name):
+        '''プログラム名からキーを検索する。
+
+        Args:
+            name (str): プログラム名 exp) O0100
+        Return:
+            list: キーのリスト
+        '''
+        return sorted(self.__get_lookup()['name'].get(name, ()))
+
+    def callers(self, name):
+        '''プログラムを呼び出しているキーを返す。
+
+        Args:
+            name (str): プログラム名 exp) O0100
+        Return:
+            list: キーのリスト
+        '''
+        return sorted(self.__get_lookup()['calls'].get(name, ()))
+
+    def search(self, tool=None, calls=None, text=None):
+        '''条件に全て一致するプログラムのキーを返す。
+
+        Args:
+            tool (int): 使用する工具番号
+            calls (str): 呼び出すプログラム名
+            text (str): プログラム名かコメントに含まれる文字列（大文字小文字は区別しない）
+        Return:
+            list: キーのリスト
+        '''
+        lookup = self.__get_lookup()
+        keys = set(self.__programs)
+        if tool is not None:
+            keys &= lookup['tools'].get(int(tool), set())
+        if calls is not None:
+            keys &= lookup['calls'].get(calls, set())
+        if text is not None:
+            text = text.lower()
+            keys = {key for key in keys if text in lookup['text'][key]}
+        return sorted(keys)
+
+    def dependencies(self, key):
+        '''プログラムと、そこから呼び出される全てのサブプログラムのキーを返す。
+
+        呼び出し先は、同じフォルダのプログラムを優先して探す。
+
+        Args:
+            key (str): キー
+        Return:
+            list: キーのリスト。先頭が指定したプログラムで、以降は呼び出される順
+        Raises:
+            Exception: 呼び出し先のプログラムがインデックスに無い
+        '''
+        if key not in self.__programs:
+            raise Exception('インデックスに存在しないプログラムです。(key: ' + key + ')')
+        result = [key]
+        visited = {key}
+        missing = []
+        position = 0
+        while position < len(result):
+            current = result[position]
+            position += 1
+            for name in self.__programs[current]['calls']:
+                target = self.__resolve(name, ProgramIndex.__folder(current))
+                if target is None:
+                    missing.append(name)
+                elif target not in visited:
+                    visited.add(target)
+                    result.append(target)
+        if missing:
+            raise Exception('呼び出し先のプログラムがインデックスにありません。(' + ', '.join(sorted(set(missing))) + ')')
+        return result
+
+    def push(self, j3, key, folder='//CNC_MEM/USER/LIBRARY/'):
+        '''ローカルのプログラムを、呼び出す全てのサブプログラムと一緒にNCに書き込む。
+
+        サブプログラムを先に書き込み、write_files()で1回にまとめて転送する。
+        ファイルの'%'の行とCRは、strip_tape()で取り除いてから書き込む。
+
+        Args:
+            j3 (J3): 書き込み先の接続
+            key (str): ローカルファイルのキー
+            folder (str): 書き込み先のフォルダ
+        Return:
+            list: 書き込んだNC内の絶対パスのリスト
+        '''
+        mapping = {}
+        for dependency in reversed(self.dependencies(key)):
+            if dependency.startswith('//'):
+                raise Exception('NC内のプログラムは書き込めません。ローカルファイルを指定して下さい。(key: ' + dependency + ')')
+            with open(dependency, 'rb') as f:
+                mapping[folder + self.__programs[dependency]['name']] = strip_tape(f.read())
+        j3.write_files(mapping)
+        return list(mapping)
+
+    def __resolve(self, name, folder):
+        '''プログラム名のキーを返す。同じフォルダにあればそれを優先する。'''
+        keys = self.__get_lookup()['name'].get(name)
+        if not keys:
+            return None
+        for key in keys:
+            if ProgramIndex.__folder(key) == folder:
+                return key
+        return min(keys)
+
+    def __get_lookup(self):
+        '''検索用の逆引き表を返す。登録内容が変わった後の初回に作り直す。'''
+        if self.__lookup is None:
+            lookup = {'name': {}, 'tools': {}, 'calls': {}, 'text': {}}
+            for key, entry in self.__programs.items():
+                lookup['name'].setdefault(entry['name'], set()).add(key)
+                for tool in entry['tools']:
+                    lookup['tools'].setdefault(tool, set()).add(key)
+                for name in entry['calls']:
+                    lookup['calls'].setdefault(name, set()).add(key)
+                lookup['text'][key] = '\n'.join([entry['name']] + entry['comments']).lower()
+            self.__lookup = lookup
+        return self.__lookup
+
+    @staticmethod
+    def __folder(key):
+        if key.startswith('//'):
+            return key.rsplit('/', 1)[0]
+        return os.path.dirname(key)
+
+    @staticmethod
+    def __basename(key):
+        if key.startswith('//'):
+            return key.rsplit('/', 1)[-1]
+        return os.path.basename(key)
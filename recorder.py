@@ -0,0 +1,339 @@
+# coding: utf-8
+'''
+PMCデバイスの時系列レコーダー
+
+J3.read_range()で読み出したPMCブロックを、ホストごとの列指向ファイルに追記する。
+
+ファイル構成:
+    <path>.j3r : ヘッダ（ブロック定義）＋セグメントの連続
+    <path>.j3i : セグメントごとの索引（開始時刻、終了時刻、オフセット、長さ）の固定長レコード
+
+セグメントは一定サンプル数ごとにまとめて書き込む。
+時刻は先頭時刻からの差分(ms)、各バイトは列ごとにランレングス圧縮して保存し、
+列ごとのオフセット表を持つため、1信号だけを読み出す際は該当列のみを展開する。
+'''
+from array import array
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import traceback
+
+from util import Interval
+
+
+_FILE_MAGIC = b'J3R1'
+_SEG_MAGIC = b'SEG1'
+_SEG_HEAD = struct.Struct('<4sIdI') # マジック, サンプル数, 先頭時刻, 列数
+_INDEX = struct.Struct('<ddQI') # 開始時刻, 終了時刻, セグメントのオフセット, セグメントの長さ
+_RUN = struct.Struct('<BH') # 値, 連続数
+
+
+def _encode_column(values):
+    '''1列分のバイト値をランレングス圧縮する。'''
+    out = bytearray()
+    prev = values[0]
+    run = 0
+    for v in values:
+        if v == prev and run < 0xFFFF:
+            run += 1
+        else:
+            out += _RUN.pack(prev, run)
+            prev = v
+            run = 1
+    out += _RUN.pack(prev, run)
+    return bytes(out)
+
+
+def _decode_column(buf, offset, length):
+    '''ランレングス圧縮された1列分を展開する。'''
+    out = bytearray()
+    for pos in range(offset, offset + length, _RUN.size):
+        v, run = _RUN.unpack_from(buf, pos)
+        out += bytes((v,)) * run
+    return out
+
+
+def _parse_dev(dev):
+    '''デバイス番号を(エリア名, アドレス番号, ビットオフセット)に分解する。ビット指定が無い場合は-1。'''
+    if dev[0] not in ('R', 'D'):
+        raise Exception('R、またはDデバイスを設定して下さい。')
+    if dev.find('.') != -1:
+        devno, offset = dev.split('.')
+        offset = int(offset)
+        if offset > 7 or 0 > offset:
+            raise Exception('デバイスのオフセット値が不正です。0~7の範囲内で指定してください。')
+        return dev[0], int(devno[1:]), offset
+    return dev[0], int(dev[1:]), -1
+
+
+class RecordWriter:
+    '''PMCブロックのサンプルを、ファイルに追記する。'''
+
+    def __init__(self, path, blocks, segment_size=256):
+        '''
+        Args:
+            path (str): 拡張子を除いた出力先パス exp) log/192.168.1.10_8193
+            blocks (list): 記録するブロックのリスト exp) [('R6600', 64), ('D11600', 32)]
+            segment_size (int): 1セグメントにまとめるサンプル数
+        '''
+        if not 0 < segment_size <= 0xFFFF:
+            raise Exception('セグメントのサンプル数は、1~65535の範囲内で指定してください。')
+        self.__blocks = [(dev, int(length)) for dev, length in blocks]
+        self.__width = sum(length for _, length in self.__blocks)
+        self.__segment_size = segment_size
+        self.__times = []
+        self.__rows = []
+        # 最後に追加したサンプルの時刻（索引を時刻順に保つため、これより前の時刻は記録しない）
+        self.__last_time = float('-inf')
+        self.__lock = threading.Lock()
+
+        data_path = path + '.j3r'
+        if os.path.exists(data_path) and os.path.getsize(data_path) > 0:
+            # 既存ファイルへの追記は、同じブロック定義の場合のみ許可
+            if RecordReader.read_header(data_path)[0] != self.__blocks:
+                raise Exception('既存の記録ファイルとブロック定義が一致しません。(path: ' + data_path + ')')
+            self.__data = open(data_path, 'ab')
+        else:
+            self.__data = open(data_path, 'wb')
+            header = json.dumps({'blocks': self.__blocks}).encode('utf-8')
+            self.__data.write(_FILE_MAGIC + struct.pack('<I', len(header)) + header)
+            self.__data.flush()
+        self.__index = open(path + '.j3i', 'ab')
+        if self.__index.tell() >= _INDEX.size:
+            with open(path + '.j3i', 'rb') as f:
+                f.seek(self.__index.tell() - self.__index.tell() % _INDEX.size - _INDEX.size)
+                self.__last_time = _INDEX.unpack(f.read(_INDEX.size))[1]
+
+    def append(self, timestamp, row):
+        '''1サンプル分のデータを追加する。セグメント分たまった時点でファイルに書き込む。
+
+        時刻が前のサンプルより戻った場合（NTPによる時刻補正など）は、前のサンプルの時刻として記録する。
+
+        Args:
+            timestamp (float): 取得時刻(UNIX時間)
+            row (bytes): 全ブロックを定義順に連結したデータ
+        '''
+        if len(row) != self.__width:
+            raise Exception('サンプルのバイト数がブロック定義と一致しません。')
+        with self.__lock:
+            timestamp = max(timestamp, self.__last_time)
+            # 先頭時刻からの差分(ms)が4byteに収まらない場合は、新しいセグメントにする
+            if self.__rows and (timestamp - self.__times[0]) * 1000 >= 0xFFFFFFFF:
+                self.__write_segment()
+            self.__last_time = timestamp
+            self.__times.append(timestamp)
+            self.__rows.append(row)
+            if len(self.__rows) >= self.__segment_size:
+                self.__write_segment()
+
+    def flush(self):
+        '''バッファ中のサンプルをセグメントとして書き込む。'''
+        with self.__lock:
+            if self.__rows:
+                self.__write_segment()
+
+    def close(self):
+        '''残りのサンプルを書き込み、ファイルを閉じる。'''
+        self.flush()
+        self.__data.close()
+        self.__index.close()
+
+    def __write_segment(self):
+        # 書き込みに失敗しても、同じサンプルで失敗し続けないようバッファは空にする
+        times, rows = self.__times, self.__rows
+        self.__times = []
+        self.__rows = []
+
+        t0 = times[0]
+        n = len(rows)
+        deltas = array('I', (int(round((t - t0) * 1000)) for t in times))
+
+        # 行データを列に転置してから、列ごとに圧縮
+        columns = [_encode_column(bytes(col)) for col in zip(*rows)]
+        offsets = array('I')
+        pos = 0
+        for col in columns:
+            offsets.append(pos)
+            pos += len(col)
+
+        segment = (_SEG_HEAD.pack(_SEG_MAGIC, n, t0, self.__width)
+            + deltas.tobytes() + offsets.tobytes() + b''.join(columns))
+        offset = self.__data.seek(0, os.SEEK_END)
+        self.__data.write(segment)
+        self.__data.flush()
+        self.__index.write(_INDEX.pack(t0, times[-1], offset, len(segment)))
+        self.__index.flush()
+
+
+class RecordReader:
+    '''RecordWriterで記録したファイルから、信号を時刻範囲で読み出す。'''
+
+    @staticmethod
+    def read_header(data_path):
+        '''記録ファイルのヘッダを読み込む。
+
+        Return:
+            tuple: (ブロック定義のリスト, ヘッダのバイト数)
+        '''
+        with open(data_path, 'rb') as f:
+            head = f.read(8)
+            if head[:4] != _FILE_MAGIC:
+                raise Exception('記録ファイルの形式が不正です。(path: ' + data_path + ')')
+            length = struct.unpack('<I', head[4:])[0]
+            header = json.loads(f.read(length).decode('utf-8'))
+        return [(dev, length) for dev, length in header['blocks']], 8 + length
+
+    def __init__(self, path):
+        '''
+        Args:
+            path (str): 拡張子を除いた記録ファイルのパス
+        '''
+        self.__data_path = path + '.j3r'
+        self.__index_path = path + '.j3i'
+        self.__blocks, _ = RecordReader.read_header(self.__data_path)
+
+        # デバイスのアドレス番号 -> 列番号の対応表
+        self.__columns = {}
+        col = 0
+        for dev, length in self.__blocks:
+            area, start, _ = _parse_dev(dev)
+            for i in range(length):
+                self.__columns.setdefault((area, start + i), col + i)
+            col += length
+
+    def blocks(self):
+        '''記録されているブロック定義を返す。'''
+        return list(self.__blocks)
+
+    def slice(self, dev, start=None, end=None, size=1):
+        '''1信号を時刻範囲で読み出す。
+
+        索引を二分探索して範囲に掛かるセグメントだけを対象にし、
+        セグメント内も該当する列だけを展開する。
+
+        Args:
+            dev (str): デバイス番号 exp) R6653 or R6653.2 or D11600
+            start (float): 開始時刻(UNIX時間)。Noneなら先頭から
+            end (float): 終了時刻(UNIX時間)。Noneなら末尾まで
+            size (int): データのサイズ(byte) exp) 1 or 2 or 4
+        Return:
+            list: (時刻, 値)のリスト。ビット指定の場合、値は0 or 1。
+        '''
+        if size not in (1, 2, 4):
+            raise Exception('サイズは、1(byte) or 2(byte) or 4(byte)のどれかを設定して下さい。')
+        area, addr, offset = _parse_dev(dev)
+        if offset != -1:
+            size = 1
+        try:
+            cols = [self.__columns[(area, addr + i)] for i in range(size)]
+        except KeyError:
+            raise Exception('指定されたデバイスは記録されていません。(dev: ' + dev + ')')
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+
+        result = []
+        with open(self.__index_path, 'rb') as fi, open(self.__data_path, 'rb') as fd:
+            if os.fstat(fi.fileno()).st_size < _INDEX.size:
+                return result
+            with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as index, \
+                    mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                count = len(index) // _INDEX.size
+
+                # 終了時刻がstart以上となる最初のセグメントを二分探索
+                lo, hi = 0, count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if _INDEX.unpack_from(index, mid * _INDEX.size)[1] < start:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+
+                for i in range(lo, count):
+                    t_start, _, seg_offset, seg_length = _INDEX.unpack_from(index, i * _INDEX.size)
+                    if t_start > end:
+                        break
+                    result += self.__read_segment(data, seg_offset, seg_length, cols, offset, start, end)
+        return result
+
+    def __read_segment(self, data, seg_offset, seg_length, cols, offset, start, end):
+        magic, n, t0, ncols = _SEG_HEAD.unpack_from(data, seg_offset)
+        if magic != _SEG_MAGIC:
+            raise Exception('記録ファイルのセグメントが壊れています。(offset: ' + str(seg_offset) + ')')
+        pos = seg_offset + _SEG_HEAD.size
+        deltas = array('I')
+        deltas.frombytes(data[pos:pos + n * deltas.itemsize])
+        pos += n * deltas.itemsize
+        offsets = array('I')
+        offsets.frombytes(data[pos:pos + ncols * offsets.itemsize])
+        pos += ncols * offsets.itemsize
+
+        # 対象の列だけを展開
+        values = []
+        for col in cols:
+            col_start = pos + offsets[col]
+            col_end = pos + offsets[col + 1] if col + 1 < ncols else seg_offset + seg_length
+            values.append(_decode_column(data, col_start, col_end - col_start))
+
+        result = []
+        for i in range(n):
+            t = t0 + deltas[i] / 1000
+            if t < start or t > end:
+                continue
+            if offset != -1:
+                value = (values[0][i] >> offset) & 1
+            elif len(values) == 1:
+                value = values[0][i]
+            else:
+                value = int.from_bytes(bytes(v[i] for v in values), 'little', signed=True)
+            result.append((t, value))
+        return result
+
+
+class Recorder:
+    '''J3接続から一定周期でPMCブロックを読み出し、RecordWriterに追記するスレッド。'''
+
+    def __init__(self, j3, path, blocks, interval=0.05, segment_size=256):
+        '''
+        Args:
+            j3 (J3): 読み出しに使う接続
+            path (str): 拡張子を除いた出力先パス。ホストごとに分けること。 exp) log/192.168.1.10_8193
+            blocks (list): 記録するブロックのリスト exp) [('R6600', 64), ('D11600', 32)]
+            interval (float): 読み出し周期(秒)
+            segment_size (int): 1セグメントにまとめるサンプル数
+        '''
+        self.__j3 = j3
+        self.__blocks = [(dev, int(length)) for dev, length in blocks]
+        self.__interval = interval
+        self.__writer = RecordWriter(path, self.__blocks, segment_size)
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        '''記録を開始する。'''
+        if self.__thread is None:
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        '''記録を停止し、ファイルを閉じる。'''
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+        self.__writer.close()
+
+    def __run(self):
+        pacing = Interval(self.__interval)
+        while not self.__stop.is_set():
+            timestamp = time.time()
+            try:
+                row = b''.join(self.__j3.read_range(dev, length) for dev, length in self.__blocks)
+                self.__writer.append(timestamp, row)
+            except:
+                # 通信エラー時はそのサンプルを欠損として記録を継続する
+                traceback.print_exc()
+            pacing.wait(self.__stop)
@@ -0,0 +1,205 @@
+# coding: utf-8
+'''
+名前付きのタグ定義と、まとめて読み出すための読み出し計画
+
+タグ定義（名前・アドレス・型・スケール）をYAML/JSON/CSVから読み込み、
+近いアドレスを範囲読み出しにまとめた読み出し計画と、デコード表に変換する。
+J3.read_tags()に渡すと、全タグを範囲読み出し数回で取得できる。
+
+定義例(JSON):
+    {
+        "spindle_load": "D11600:int16",
+        "door_closed": "R6653.2",
+        "feed_rate": {"address": "D11610", "type": "uint32", "scale": 0.1}
+    }
+
+定義例(CSV): name,address,type,scale,offset のヘッダ行を持つ
+    spindle_load,D11600,int16,1,0
+    door_closed,R6653.2,bit,,
+'''
+import csv
+import json
+import os
+import struct
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# 型名 -> (バイト数, structの書式)
+TYPES = {
+    'bit': (1, 'B'),
+    'uint8': (1, 'B'),
+    'int8': (1, 'b'),
+    'uint16': (2, '<H'),
+    'int16': (2, '<h'),
+    'uint32': (4, '<I'),
+    'int32': (4, '<i'),
+    'float32': (4, '<f'),
+}
+
+
+class Tag:
+    '''1つのタグの定義。'''
+
+    def __init__(self, name, address, type=None, scale=1, offset=0):
+        '''
+        Args:
+            name (str): タグ名
+            address (str): デバイス番号 exp) D11600 or R6653.2
+            type (str): 型名。Noneならビット指定はbit、それ以外はuint8
+            scale (float): 読み出した値に掛ける倍率
+            offset (float): 倍率を掛けた後に足す値
+        '''
+        if address[0:1] not in ('R', 'D'):
+            raise Exception('R、またはDデバイスを設定して下さい。(tag: ' + name + ')')
+        self.name = name
+        self.address = address
+        self.bit = -1
+        devno = address
+        if address.find('.') != -1:
+            devno, bit = address.split('.')
+            self.bit = int(bit)
+            if self.bit > 7 or 0 > self.bit:
+                raise Exception('デバイスのオフセット値が不正です。0~7の範囲内で指定してください。(tag: ' + name + ')')
+        self.area = address[0]
+        self.number = int(devno[1:])
+        self.type = type or ('bit' if self.bit != -1 else 'uint8')
+        if self.type not in TYPES:
+            raise Exception('型名が不正です。' + ', '.join(TYPES) + 'のどれかを設定して下さい。(tag: ' + name + ')')
+        if (self.type == 'bit') != (self.bit != -1):
+            raise Exception('bit型はビット指定(exp: R6653.2)のアドレスでのみ使用できます。(tag: ' + name + ')')
+        self.size = TYPES[self.type][0]
+        self.scale = scale if scale not in (None, '') else 1
+        self.offset = offset if offset not in (None, '') else 0
+
+
+class TagMap:
+    '''タグ定義の集合。compile()で読み出し計画とデコード表を作成する。'''
+
+    def __init__(self, tags, max_gap=16, max_length=256):
+        '''
+        Args:
+            tags (list): Tagのリスト
+            max_gap (int): この値以下の隙間のアドレスは、1回の範囲読み出しにまとめる
+            max_length (int): 1回の範囲読み出しの最大バイト数
+        '''
+        self.__tags = list(tags)
+        names = [tag.name for tag in self.__tags]
+        if len(set(names)) != len(names):
+            raise Exception('タグ名が重複しています。')
+        self.__max_gap = max_gap
+        self.__max_length = max_length
+        self.__plan = None
+        self.__decoders = None
+
+    @classmethod
+    def load(cls, file_path, **kwargs):
+        '''ファイルからタグ定義を読み込む。拡張子で形式を判定する（.json, .csv, .yaml, .yml）。
+
+        Args:
+            file_path (str): 定義ファイルのパス
+            kwargs: TagMap()の引数
+        Return:
+            TagMap: 読み込んだタグ定義
+        '''
+        ext = os.path.splitext(file_path)[1].lower()
+        with open(file_path, 'r', encoding='utf-8', newline='') as f:
+            if ext == '.json':
+                return cls.from_dict(json.load(f), **kwargs)
+            elif ext in ('.yaml', '.yml'):
+                if yaml is None:
+                    raise Exception('YAML形式の読み込みにはPyYAMLが必要です。(pip install pyyaml)')
+                return cls.from_dict(yaml.safe_load(f), **kwargs)
+            elif ext == '.csv':
+                tags = []
+                for row in csv.DictReader(f):
+                    tags.append(Tag(
+                        row['name'], row['address'], row.get('type') or None,
+                        float(row['scale']) if row.get('scale') else 1,
+                        float(row['offset']) if row.get('offset') else 0))
+                return cls(tags, **kwargs)
+        raise Exception('定義ファイルの形式は、json, csv, yaml, ymlのどれかを設定して下さい。(path: ' + file_path + ')')
+
+    @classmethod
+    def from_dict(cls, definition, **kwargs):
+        '''dictからタグ定義を作成する。
+
+        Args:
+            definition (dict): タグ名 -> 'アドレス:型' または {'address', 'type', 'scale', 'offset'}
+            kwargs: TagMap()の引数
+        Return:
+            TagMap: タグ定義
+        '''
+        tags = []
+        for name, value in definition.items():
+            if isinstance(value, str):
+                address, _, type_name = value.partition(':')
+                tags.append(Tag(name, address.strip(), type_name.strip() or None))
+            else:
+                tags.append(Tag(name, value['address'], value.get('type'), value.get('scale', 1), value.get('offset', 0)))
+        return cls(tags, **kwargs)
+
+    def names(self):
+        '''タグ名のリストを返す。'''
+        return [tag.name for tag in self.__tags]
+
+    def tags(self):
+        '''Tagのリストを返す。'''
+        return list(self.__tags)
+
+    def compile(self):
+        '''読み出し計画とデコード表を作成する。plan()、decode()の初回に自動で呼ばれる。'''
+        plan = []
+        placement = {}
+        for area in ('R', 'D'):
+            tags = sorted((tag for tag in self.__tags if tag.area == area), key=lambda tag: tag.number)
+            span = None
+            for tag in tags:
+                end = tag.number + tag.size
+                # 隙間が小さく、最大バイト数に収まるなら前の範囲を広げる
+                if span is not None and tag.number - span[1] <= self.__max_gap and end - span[0] <= self.__max_length:
+                    span[1] = max(span[1], end)
+                else:
+                    span = [tag.number, end]
+                    plan.append((area, span))
+                placement[tag.name] = (len(plan) - 1, tag.number - span[0])
+
+        self.__plan = [(area + str(start), end - start) for area, (start, end) in plan]
+        self.__decoders = []
+        for tag in self.__tags:
+            index, position = placement[tag.name]
+            unpack_from = struct.Struct(TYPES[tag.type][1]).unpack_from
+            self.__decoders.append((tag.name, index, position, unpack_from, tag.bit, tag.scale, tag.offset))
+
+    def plan(self):
+        '''読み出し計画を返す。
+
+        Return:
+            list: (先頭のデバイス番号, バイト数)のリスト exp) [('R6653', 2), ('D11600', 24)]
+        '''
+        if self.__plan is None:
+            self.compile()
+        return list(self.__plan)
+
+    def decode(self, blocks):
+        '''読み出し計画の順に読み出したデータから、全タグの値を取り出す。
+
+        Args:
+            blocks (list): plan()の各範囲を読み出したbytesのリスト
+        Return:
+            dict: タグ名 -> 値
+        '''
+        if self.__decoders is None:
+            self.compile()
+        result = {}
+        for name, index, position, unpack_from, bit, scale, offset in self.__decoders:
+            value = unpack_from(blocks[index], position)[0]
+            if bit != -1:
+                value = (value >> bit) & 1
+            elif scale != 1 or offset != 0:
+                value = value * scale + offset
+            result[name] = value
+        return result
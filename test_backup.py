@@ -0,0 +1,76 @@
+# coding: utf-8
+'''
+加工プログラムのバックアップアーカイブのテストです。
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from backup import ProgramArchive
+from dummy_j3 import DummyJ3
+
+
+class TestBackup(unittest.TestCase):
+
+    def setUp(self):
+        '''テストごとに開始前に必ず実行'''
+        self.tmpdir = tempfile.mkdtemp()
+        self.archive = ProgramArchive(self.tmpdir)
+
+    def tearDown(self):
+        '''テストごとに終了後に必ず実行'''
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_get(self):
+        '''保存したプログラムを取り出せるか、同じ内容は1つだけ保存されるかテスト。'''
+        data = b'O8990\nG4X10. \nM30' * 100
+        digest = self.archive.put(data)
+        self.assertEqual(self.archive.put(data), digest)
+        self.assertEqual(self.archive.get(digest), data)
+        self.assertLess(os.path.getsize(os.path.join(self.tmpdir, 'objects', digest[:2], digest)), len(data))
+        # 圧縮形式が異なるアーカイブからも取り出せるか
+        self.assertEqual(ProgramArchive(self.tmpdir, compression='zlib').get(digest), data)
+
+    def test_backup_restore(self):
+        '''変化の無いプログラムを読み込まずにバックアップし、リストアできるかテスト。'''
+        programs = {'O0001': b'O0001\nM30', 'O0002': b'O0002\nM99'}
+        j3_a = DummyJ3(programs)
+        j3_b = DummyJ3(programs)
+
+        # 1. 1台目の初回は全て読み込む
+        result = self.archive.backup(j3_a, '192.168.1.10:8193', snapshot='1')
+        self.assertEqual((result['total'], result['read'], result['stored']), (2, 2, 2))
+        # 2. 2台目は読み込むが、同じ内容なので保存はしない
+        result = self.archive.backup(j3_b, '192.168.1.11:8193', snapshot='1')
+        self.assertEqual((result['read'], result['stored']), (2, 0))
+        # 3. 変化が無ければ読み込まない
+        result = self.archive.backup(j3_a, '192.168.1.10:8193', snapshot='2')
+        self.assertEqual((result['read'], result['stored']), (0, 0))
+        self.assertEqual(j3_a.read_count, 2)
+        # 4. 変更したプログラムだけ読み込む
+        j3_a.write_file('//CNC_MEM/USER/LIBRARY/O0002', b'O0002\nG4X1.\nM99')
+        result = self.archive.backup(j3_a, '192.168.1.10:8193', snapshot='3')
+        self.assertEqual((result['read'], result['stored']), (1, 1))
+        self.assertEqual(self.archive.snapshots('192.168.1.10:8193'), ['1', '2', '3'])
+
+        # 5. 過去のスナップショットをリストア
+        paths = self.archive.restore(j3_a, '192.168.1.10:8193', snapshot='1')
+        self.assertEqual(paths, ['//CNC_MEM/USER/LIBRARY/O0001', '//CNC_MEM/USER/LIBRARY/O0002'])
+        self.assertEqual(j3_a.programs, programs)
+        with self.assertRaises(Exception):
+            self.archive.restore(j3_a, '192.168.1.12:8193')
+
+    def test_numeric_names(self):
+        '''find_dir()の名前に'O'が付かないNCでも、O番号のパスでバックアップ・リストアできるかテスト。'''
+        programs = {'O0001': b'O0001\nM30', 'O0002': b'O0002\nM99'}
+        j3 = DummyJ3(programs, numeric_names=True)
+        self.archive.backup(j3, '192.168.1.10:8193', snapshot='1')
+        self.assertEqual(sorted(self.archive.manifest('192.168.1.10:8193')),
+            ['//CNC_MEM/USER/LIBRARY/O0001', '//CNC_MEM/USER/LIBRARY/O0002'])
+        j3.programs = {}
+        self.archive.restore(j3, '192.168.1.10:8193')
+        self.assertEqual(j3.programs, programs)
+
+if __name__ == '__main__':
+    unittest.main()
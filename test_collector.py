@@ -0,0 +1,71 @@
+# coding: utf-8
+'''
+複数プロセスのコレクターのテストです。
+'''
+import queue
+import threading
+import unittest
+
+from collector import FleetCollector, _worker
+from dummy_j3 import DummyJ3
+
+
+def dummy_connector(host):
+    if host.startswith('0.0.0.0'):
+        raise Exception('接続できません。')
+    return DummyJ3()
+
+
+class CountingConnector:
+    '''接続を試みた回数を数える、テスト用の接続関数。'''
+
+    def __init__(self):
+        self.attempts = {}
+
+    def __call__(self, host):
+        self.attempts[host] = self.attempts.get(host, 0) + 1
+        return dummy_connector(host)
+
+
+class TestCollector(unittest.TestCase):
+
+    def test_collect(self):
+        '''全ホストの結果が親プロセスに届くかテスト。'''
+        hosts = ['192.168.1.%d:8193' % i for i in range(10, 16)] + ['0.0.0.0:8193']
+        blocks = [('R6600', 4), ('D11600', 2)]
+        received = {}
+        with FleetCollector(hosts, blocks, interval=0.05, processes=3, connector=dummy_connector) as collector:
+            for host, timestamp, data, error in collector.results(timeout=30):
+                received[host] = (data, error)
+                if len(received) == len(hosts):
+                    break
+        self.assertEqual(set(received), set(hosts))
+        self.assertEqual(received['192.168.1.10:8193'], ([b'\xc8\xc9\xca\xcb', b'\x50\x51'], None))
+        self.assertIsNone(received['0.0.0.0:8193'][0])
+        self.assertIsNotNone(received['0.0.0.0:8193'][1])
+
+    def test_backoff(self):
+        '''接続できないホストを、毎周期は接続し直さないかテスト。'''
+        connector = CountingConnector()
+        results = queue.Queue()
+        stop = threading.Event()
+        hosts = ['192.168.1.10:8193', '0.0.0.0:8193']
+        thread = threading.Thread(target=_worker,
+            args=(hosts, [('R6600', 4)], 0.01, 64, connector, results, stop, 0.08))
+        thread.start()
+        stop.wait(0.5)
+        stop.set()
+        thread.join()
+        records = []
+        while not results.empty():
+            records.extend(results.get())
+        ok = [record for record in records if record[0] == hosts[0]]
+        failed = [record for record in records if record[0] == hosts[1]]
+        # 0.5秒間に、正常なホストは周期ごとに読み出し、失敗したホストは待ち時間(0.02, 0.04, 0.08, 0.08...)ごとに接続し直す
+        self.assertGreater(len(ok), 20)
+        self.assertLess(connector.attempts[hosts[1]], 12)
+        self.assertEqual(len(failed), connector.attempts[hosts[1]])
+        self.assertEqual(connector.attempts[hosts[0]], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,7 +10,8 @@ import os
 import sys
 import unittest
 
-from j3 import J3
+from j3 import J3, FocasError, FocasDataError
+from tags import TagMap
 
 
 class TestJ3(unittest.TestCase):
@@ -188,6 +189,108 @@ class TestJ3(unittest.TestCase):
         # lastly. 最後も初期化しておく
         self.j3.write_dev('R6653', 0)
 
+    def test_bits_operation(self):
+        '''複数ビットの一括操作テスト。'''
+        self.j3.write_range('R6653', b'\x00\x00')
+        # 1. 複数バイトにまたがるビットを1にする
+        self.j3.set_bits('R6653', 0b0000000100000101, verify=True)
+        self.assertEqual(self.j3.read_range('R6653', 2), b'\x05\x01')
+        self.assertEqual(self.j3.read_dev('R6653.2'), 1)
+        # 2. ビットを0にする、反転する
+        self.j3.clear_bits('R6653', 0b00000001)
+        self.assertEqual(self.j3.read_dev('R6653'), 4)
+        self.j3.toggle_bits('R6653', b'\x0f\x01', verify=True)
+        self.assertEqual(self.j3.read_range('R6653', 2), b'\x0b\x00')
+        # lastly. 最後も初期化しておく
+        self.j3.write_range('R6653', b'\x00\x00')
+
+    def test_tags_operation(self):
+        '''タグ定義による一括読み出しテスト。'''
+        tags = TagMap.from_dict({
+            'word': 'D11600:int16',
+            'byte': 'D11602',
+            'flag': 'R6653.2'})
+        self.j3.write_dev('D11600', -10, size=2)
+        self.j3.write_dev('D11602', 3)
+        self.j3.write_dev('R6653', 4)
+        values = self.j3.read_tags(tags)
+        self.assertEqual(values, {'word': -10, 'byte': 3, 'flag': 1})
+        for tag in tags.tags():
+            self.assertEqual(self.j3.read_dev(tag.address, size=tag.size), values[tag.name])
+        # lastly. 最後も初期化しておく
+        self.j3.write_range('D11600', bytes(3))
+        self.j3.write_dev('R6653', 0)
+
+    def test_profile(self):
+        '''接続先の機能と上限を取得できるかテスト。'''
+        profile = self.j3.profile()
+        self.assertIn('D', profile['pmc_areas'])
+        self.assertGreaterEqual(profile['pmc_range_max'], 1)
+        self.assertGreaterEqual(profile['dir_page'], 1)
+        # 上限を超える範囲読み出しも、分割して読み出せるか
+        area = profile['pmc_areas']['D']
+        length = min(profile['pmc_range_max'] * 2 + 1, area[1] - area[0] + 1)
+        self.assertEqual(len(self.j3.read_range('D' + str(area[0]), length)), length)
+        # 範囲外はNCに問い合わせずにエラー
+        with self.assertRaises(FocasDataError):
+            self.j3.read_range('D' + str(area[1]), 2)
+
+    def test_error_operation(self):
+        '''エラーコードに対応する例外が送出されるかテスト。'''
+        # 1. 範囲外のアドレスはFocasDataError
+        with self.assertRaises(FocasDataError) as cm:
+            self.j3.read_range('D99999', 4)
+        self.assertEqual(cm.exception.func, 'pmc_rdpmcrng')
+        self.assertFalse(cm.exception.retryable)
+        # 2. FocasErrorとしても、Exceptionとしても捕捉できるか
+        self.assertIsInstance(cm.exception, FocasError)
+        with self.assertRaises(Exception):
+            self.j3.read_range('D99999', 4)
+
+    def test_range_operation(self):
+        '''範囲読み書きと、非同期書き込みキューのテスト。'''
+        # 1. D11600~D11603に範囲書き込みし、1byteずつ一致するかテスト
+        self.j3.write_range('D11600', b'\x01\x02\x03\x04')
+        self.assertEqual(self.j3.read_range('D11600', 4), b'\x01\x02\x03\x04')
+        self.assertEqual(self.j3.read_dev('D11602'), 3)
+        # 2. 同じアドレスへの書き込みは最後の値が書き込まれるかテスト
+        queue = J3.get_write_queue('192.168.48.*:8193')
+        queue.write('D11600', 10)
+        queue.write('D11600', 20)
+        future = queue.write('D11601', 1000, size=2)
+        queue.write('R6653', 0)
+        queue.write('R6653.1', 1)
+        queue.flush()
+        self.assertIsNone(future.result())
+        self.assertEqual(self.j3.read_range('D11600', 4), b'\x14\xe8\x03\x04')
+        self.assertEqual(self.j3.read_dev('R6653'), 2)
+        queue.close()
+        # lastly. 最後も初期化しておく
+        self.j3.write_range('D11600', bytes(5))
+        self.j3.write_dev('R6653', 0)
+
+    def test_cache_operation(self):
+        '''読み出しキャッシュのテスト。'''
+        self.j3.write_range('D11600', b'\x01\x02\x03\x04')
+        self.j3.enable_cache()
+        try:
+            self.j3.set_cache_ttl('D11600', 60, length=4)
+            # 1. 範囲内の1回目の読み出しでまとめて取得し、以降はキャッシュから返るかテスト
+            self.assertEqual(self.j3.read_dev('D11600'), 1)
+            self.assertEqual(self.j3.read_dev('D11602', size=2), 1027)
+            stats = self.j3.cache_stats()
+            self.assertEqual(stats['misses'], 1)
+            self.assertEqual(stats['hits'], 1)
+            # 2. 書き込んだアドレスのキャッシュが破棄されるかテスト
+            self.j3.write_dev('D11601', 10)
+            self.assertEqual(self.j3.read_dev('D11601'), 10)
+            self.j3.write_dev('D11600.7', 1)
+            self.assertEqual(self.j3.read_dev('D11600'), 129)
+        finally:
+            self.j3.disable_cache()
+        # lastly. 最後も初期化しておく
+        self.j3.write_range('D11600', bytes(4))
+
     def test_file_operation(self):
         '''加工ファイル操作テスト。'''
         # 1. ファイルの書き込み、存在確認、読み込み、削除を行う
@@ -199,6 +302,57 @@ class TestJ3(unittest.TestCase):
         self.assertEqual(self.j3.read_file('//CNC_MEM/USER/LIBRARY/O8990'), b'O8990\nG4X10. \nM30')
         self.j3.delete_file('//CNC_MEM/USER/LIBRARY/O8990')
 
+    def test_long_file_operation(self):
+        '''転送バッファ(1024byte)より長い加工ファイルの読み込みテスト。'''
+        self.skipTest('不揮発性メモリのため、書き込みに回数制限があり、必要な時以外'\
+            '(read_file, read_files, iter_fileの変更時)はskip。')
+        data = b'O8990\n' + b'G4 X10.\n' * 300 + b'M30\n%'
+        expected = b'O8990\n' + b'G4X10. \n' * 300 + b'M30'
+        self.j3.write_file('//CNC_MEM/USER/LIBRARY/O8990', data)
+        # 1. 2回目以降の受信データの先頭が欠けないか
+        self.assertEqual(self.j3.read_file('//CNC_MEM/USER/LIBRARY/O8990'), expected)
+        self.assertEqual(self.j3.read_files(['//CNC_MEM/USER/LIBRARY/O8990'])['//CNC_MEM/USER/LIBRARY/O8990'], expected)
+        self.assertEqual(b''.join(self.j3.iter_file('//CNC_MEM/USER/LIBRARY/O8990')), expected)
+        # 2. 末文字の'LF%'が受信データの区切りをまたいでも、読み込みを終了するか
+        #    受信データは'%LF'+プログラム+'LF%'のため、プログラムが1021byteなら'LF'と'%'が分かれる
+        data = b'O8990\n' + b'G4 X10.\n' * 123 + b'G4 X1.\n' * 4 + b'M30\n%'
+        expected = b'O8990\n' + b'G4X10. \n' * 123 + b'G4X1. \n' * 4 + b'M30'
+        self.assertEqual(len(expected), 1021)
+        self.j3.write_file('//CNC_MEM/USER/LIBRARY/O8990', data)
+        self.assertEqual(self.j3.read_file('//CNC_MEM/USER/LIBRARY/O8990'), expected)
+        self.j3.delete_file('//CNC_MEM/USER/LIBRARY/O8990')
+
+    def test_files_operation(self):
+        '''複数の加工ファイルの一括操作テスト。'''
+        self.skipTest('不揮発性メモリのため、書き込みに回数制限があり、必要な時以外'\
+            '(write_files, read_filesの変更時)はskip。')
+        data = {
+            '//CNC_MEM/USER/LIBRARY/O8990': b'O8990\nG4 X10.\nM30\n%',
+            '//CNC_MEM/USER/LIBRARY/O8991': b'O8991\nG4 X20.\nM30\n%'}
+        self.j3.write_files(data)
+        result = self.j3.read_files(list(data))
+        self.assertEqual(result['//CNC_MEM/USER/LIBRARY/O8990'], b'O8990\nG4X10. \nM30')
+        self.assertEqual(result['//CNC_MEM/USER/LIBRARY/O8991'], b'O8991\nG4X20. \nM30')
+        # 存在しないプログラムを含む場合は例外
+        with self.assertRaises(Exception):
+            self.j3.read_files(['//CNC_MEM/USER/LIBRARY/O8992'])
+        self.j3.delete_file('//CNC_MEM/USER/LIBRARY/O8990')
+        self.j3.delete_file('//CNC_MEM/USER/LIBRARY/O8991')
+
+    def test_transfer_job(self):
+        '''バックグラウンドでの加工ファイル転送テスト。'''
+        self.skipTest('不揮発性メモリのため、書き込みに回数制限があり、必要な時以外'\
+            '(start_write_file, start_read_file, iter_fileの変更時)はskip。')
+        data = b'O8990\nG4 X10.\nM30\n%'
+        job = self.j3.start_write_file('//CNC_MEM/USER/LIBRARY/O8990', data)
+        self.assertIsNone(job.result(timeout=60))
+        self.assertEqual(job.progress()['state'], 'done')
+        job = self.j3.start_read_file('//CNC_MEM/USER/LIBRARY/O8990')
+        self.assertEqual(job.result(timeout=60), b'O8990\nG4X10. \nM30')
+        self.assertEqual(job.progress()['percent'], 100.0)
+        self.assertEqual(b''.join(self.j3.iter_file('//CNC_MEM/USER/LIBRARY/O8990')), b'O8990\nG4X10. \nM30')
+        self.j3.delete_file('//CNC_MEM/USER/LIBRARY/O8990')
+
     def test_dir_operation(self):
         '''ディレクトリ操作テスト。'''
         dir_list = self.j3.find_dir('//CNC_MEM/')
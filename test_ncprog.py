@@ -0,0 +1,122 @@
+# coding: utf-8
+'''
+NCプログラムの解析とインデックスのテストです。
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from dummy_j3 import DummyJ3
+from ncprog import ProgramIndex, normalize_name, scan, strip_tape, tokenize
+
+
+MAIN = b'%\nO0100(MAIN PART)\nN10 T01 M06\n(ROUGH)\nG00 X-1.5 Y.5\nM98 P2000\nT2M6\nG65 P9010 A1.\nM30\n%\n'
+SUB = b'%\nO2000(SUB)\nG01 X1.\nM98 P30200\nM99\n%\n'
+MACRO = b'%\nO9010\n#1=[#2+1]\nM99\n%\n'
+DRILL = b'%\nO0200\nT5M6\nG81 X0 Y0 Z-5. R1. F100\nM99\n%\n'
+
+
+class TestNCProgram(unittest.TestCase):
+
+    def setUp(self):
+        '''テストごとに開始前に必ず実行'''
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        '''テストごとに終了後に必ず実行'''
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        file_path = os.path.join(self.tmpdir, 'lib', name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return file_path
+
+    def test_scan(self):
+        '''分割されたデータから、プログラムの情報を取り出せるかテスト。'''
+        # 1. 途中で分割しても、一括で解析した結果と同じになるか
+        chunks = [MAIN[i:i + 7] for i in range(0, len(MAIN), 7)]
+        info = scan(chunks)
+        self.assertEqual(info, scan(MAIN))
+        self.assertEqual(info['name'], 'O0100')
+        self.assertEqual(info['comment'], 'MAIN PART')
+        self.assertEqual(info['comments'], ['MAIN PART', 'ROUGH'])
+        self.assertEqual(info['tools'], [1, 2])
+        self.assertEqual(info['tool_changes'], 2)
+        self.assertEqual(info['calls'], ['O2000', 'O9010'])
+        self.assertEqual(info['blocks'], 8)
+        self.assertEqual(info['size'], len(MAIN))
+        # 2. Pの上の桁は繰り返し回数、<NAME>指定の呼び出し
+        self.assertEqual(scan(SUB)['calls'], ['O0200'])
+        self.assertEqual(scan(b'<MAIN_A>\nM98 <SUB_B>\nM30')['calls'], ['SUB_B'])
+        # 3. O番号で始まらないファイルは、途中のGOTOなどをプログラム名にしない
+        macro = scan(b'%\n#1=5\nIF[#1EQ5]GOTO10\nM98 P10\nN10 M99\n%\n')
+        self.assertIsNone(macro['name'])
+        self.assertEqual(macro['calls'], ['O0010'])
+        # 4. '%'の行とCRを取り除く
+        self.assertEqual(strip_tape(b'%\r\nO0100\r\nM30\r\n%\r\n'), b'O0100\nM30')
+        self.assertEqual(strip_tape(b'O0100\nM30\n'), b'O0100\nM30')
+        self.assertEqual([normalize_name(name) for name in ('100', 'O100', 'O0100', 'MAIN_A')], ['O0100', 'O0100', 'O0100', 'MAIN_A'])
+        # 5. マクロ式の数値以外は値をNoneにする
+        self.assertEqual(list(tokenize(b'G00X-1.5(A)\nZ#1')), [[('G', '00'), ('X', '-1.5'), ('(', 'A')], [('Z', None)]])
+
+    def test_index(self):
+        '''変更したファイルだけ解析し直すか、依存関係を含めて転送できるかテスト。'''
+        main_path = self.write('O0100', MAIN)
+        self.write('O2000', SUB.replace(b'\n', b'\r\n'))
+        self.write('O9010', MACRO)
+        self.write('O0200', DRILL)
+        index_path = os.path.join(self.tmpdir, 'index.json')
+
+        # 1. 初回は全て解析し、2回目は解析しない
+        index = ProgramIndex(index_path)
+        self.assertEqual(index.update_dir(os.path.join(self.tmpdir, 'lib')), {'total': 4, 'scanned': 4, 'removed': 0})
+        index = ProgramIndex(index_path)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.update_dir(os.path.join(self.tmpdir, 'lib')), {'total': 4, 'scanned': 0, 'removed': 0})
+
+        # 2. 検索
+        self.assertEqual(index.search(tool=5), [index.find('O0200')[0]])
+        self.assertEqual(index.search(text='rough'), [main_path])
+        self.assertEqual(index.callers('O2000'), [main_path])
+        self.assertEqual(index.search(tool=1, calls='O9010'), [main_path])
+
+        # 3. サブプログラムを先にして転送
+        names = [index.get(key)['name'] for key in index.dependencies(main_path)]
+        self.assertEqual(names, ['O0100', 'O2000', 'O9010', 'O0200'])
+        j3 = DummyJ3({})
+        paths = index.push(j3, main_path)
+        self.assertEqual(paths[-1], '//CNC_MEM/USER/LIBRARY/O0100')
+        # '%'の行とCRを取り除き、read_file()/write_file()と同じ形式で書き込む
+        self.assertEqual(j3.written['//CNC_MEM/USER/LIBRARY/O2000'], b'O2000(SUB)\nG01 X1.\nM98 P30200\nM99')
+        self.assertEqual(j3.written['//CNC_MEM/USER/LIBRARY/O0100'], strip_tape(MAIN))
+
+        # 4. O番号の無いファイルは、ファイル名をプログラム名にする
+        macro_path = self.write('MACRO1.nc', b'#1=5\nIF[#1EQ5]GOTO10\nN10 M99\n')
+        index.update_dir(os.path.join(self.tmpdir, 'lib'))
+        self.assertEqual(index.get(macro_path)['name'], 'MACRO1.nc')
+        self.assertEqual(index.find('O0010'), [])
+
+        # 5. 削除したファイルはインデックスからも削除し、呼び出し先が無ければエラー
+        os.remove(os.path.join(self.tmpdir, 'lib', 'O0200'))
+        self.assertEqual(index.update_dir(os.path.join(self.tmpdir, 'lib')), {'total': 4, 'scanned': 0, 'removed': 1})
+        with self.assertRaises(Exception):
+            index.dependencies(main_path)
+
+    def test_update_nc(self):
+        '''NC内のプログラムを、変化したものだけ読み込むかテスト。'''
+        j3 = DummyJ3({'O0100': MAIN, 'O2000': SUB})
+        index = ProgramIndex(os.path.join(self.tmpdir, 'index.json'))
+        self.assertEqual(index.update_nc(j3), {'total': 2, 'scanned': 2, 'removed': 0})
+        self.assertEqual(index.update_nc(j3), {'total': 2, 'scanned': 0, 'removed': 0})
+        self.assertEqual(j3.read_count, 2)
+        self.assertEqual(index.get('//CNC_MEM/USER/LIBRARY/O0100')['hash'], scan(MAIN)['hash'])
+        # find_dir()の名前に'O'が付かないNCでも、O番号のパスで登録する
+        index = ProgramIndex(os.path.join(self.tmpdir, 'index2.json'))
+        index.update_nc(DummyJ3({'O0100': MAIN, 'O2000': SUB}, numeric_names=True))
+        self.assertEqual(index.keys(), ['//CNC_MEM/USER/LIBRARY/O0100', '//CNC_MEM/USER/LIBRARY/O2000'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# coding: utf-8
+'''
+時系列レコーダーの記録ファイルの読み書きテストです。
+
+NCへの接続は不要です。
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from recorder import RecordWriter, RecordReader
+
+
+class TestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        '''テストごとに開始前に必ず実行'''
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, '192.168.1.10_8193')
+        self.blocks = [('R6653', 2), ('D11600', 4)]
+
+    def tearDown(self):
+        '''テストごとに終了後に必ず実行'''
+        shutil.rmtree(self.tmpdir)
+
+    def write_samples(self, count, segment_size):
+        writer = RecordWriter(self.path, self.blocks, segment_size=segment_size)
+        for i in range(count):
+            r = bytes((i // 10 % 256, 0x55))
+            d = (i * -3).to_bytes(4, 'little', signed=True)
+            writer.append(1000.0 + i * 0.05, r + d)
+        writer.close()
+
+    def test_slice(self):
+        '''記録した値を時刻範囲で取り出せるかテスト。'''
+        self.write_samples(1000, 64)
+        reader = RecordReader(self.path)
+        self.assertEqual(reader.blocks(), self.blocks)
+
+        # 全範囲
+        values = reader.slice('R6653')
+        self.assertEqual(len(values), 1000)
+        self.assertEqual([v for _, v in values], [i // 10 % 256 for i in range(1000)])
+        # 時刻範囲の指定
+        values = reader.slice('D11600', 1010.0, 1020.0, size=4)
+        self.assertEqual(len(values), 201)
+        self.assertAlmostEqual(values[0][0], 1010.0)
+        self.assertEqual(values[0][1], -600)
+        self.assertEqual(values[-1][1], -1200)
+        # ビット指定
+        values = reader.slice('R6654.2', 1000.0, 1000.5)
+        self.assertEqual([v for _, v in values], [1] * 11)
+        values = reader.slice('R6654.1', 1000.0, 1000.5)
+        self.assertEqual([v for _, v in values], [0] * 11)
+        # 範囲外
+        self.assertEqual(reader.slice('R6653', 2000.0, 3000.0), [])
+        with self.assertRaises(Exception):
+            reader.slice('D11700')
+
+    def test_append_existing(self):
+        '''既存の記録ファイルに追記できるかテスト。'''
+        self.write_samples(100, 32)
+        writer = RecordWriter(self.path, self.blocks)
+        writer.append(2000.0, bytes(6))
+        writer.close()
+        values = RecordReader(self.path).slice('R6653', 1999.0)
+        self.assertEqual(values, [(2000.0, 0)])
+        # ブロック定義が異なる場合は例外
+        with self.assertRaises(Exception):
+            RecordWriter(self.path, [('R6653', 1)])
+
+    def test_time_step_back(self):
+        '''時刻が戻っても記録を続け、時刻順に読み出せるかテスト。'''
+        writer = RecordWriter(self.path, self.blocks, segment_size=2)
+        writer.append(1000.0, bytes(6))
+        writer.append(999.5, bytes((1, 0, 0, 0, 0, 0)))
+        writer.append(1000.5, bytes((2, 0, 0, 0, 0, 0)))
+        writer.close()
+        # 追記時も、既存の記録より前の時刻にはならない
+        writer = RecordWriter(self.path, self.blocks)
+        writer.append(900.0, bytes((3, 0, 0, 0, 0, 0)))
+        writer.close()
+        values = RecordReader(self.path).slice('R6653')
+        self.assertEqual(values, [(1000.0, 0), (1000.0, 1), (1000.5, 2), (1000.5, 3)])
+
+    def test_compression(self):
+        '''変化の少ない信号が圧縮されているかテスト。'''
+        writer = RecordWriter(self.path, self.blocks, segment_size=1000)
+        for i in range(2000):
+            writer.append(1000.0 + i * 0.05, bytes((i // 50 % 2, 0x55, 10, 0, 0, 0)))
+        writer.close()
+        raw_size = 2000 * (6 + 8) # 1サンプルあたり データ6byte + 時刻8byte
+        self.assertLess(os.path.getsize(self.path + '.j3r'), raw_size / 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# coding: utf-8
+'''
+タグ定義と読み出し計画のテストです。
+
+NCへの接続は不要です。
+'''
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from tags import Tag, TagMap
+
+
+class TestTags(unittest.TestCase):
+
+    def setUp(self):
+        '''テストごとに開始前に必ず実行'''
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        '''テストごとに終了後に必ず実行'''
+        shutil.rmtree(self.tmpdir)
+
+    def test_load(self):
+        '''JSONとCSVの定義ファイルを読み込めるかテスト。'''
+        json_path = os.path.join(self.tmpdir, 'tags.json')
+        with open(json_path, 'w') as f:
+            json.dump({
+                'spindle_load': 'D11600:int16',
+                'door_closed': 'R6653.2',
+                'feed_rate': {'address': 'D11610', 'type': 'uint32', 'scale': 0.5}}, f)
+        self.assertEqual(TagMap.load(json_path).names(), ['spindle_load', 'door_closed', 'feed_rate'])
+
+        csv_path = os.path.join(self.tmpdir, 'tags.csv')
+        with open(csv_path, 'w') as f:
+            f.write('name,address,type,scale,offset\n')
+            f.write('spindle_load,D11600,int16,,\n')
+            f.write('door_closed,R6653.2,,,\n')
+        self.assertEqual(TagMap.load(csv_path).names(), ['spindle_load', 'door_closed'])
+
+        # 不正な定義は例外
+        with self.assertRaises(Exception):
+            Tag('x', 'X100')
+        with self.assertRaises(Exception):
+            Tag('x', 'D100', 'int64')
+        with self.assertRaises(Exception):
+            Tag('x', 'D100', 'bit')
+        with self.assertRaises(Exception):
+            TagMap([Tag('x', 'D100'), Tag('x', 'D101')])
+
+    def test_plan_decode(self):
+        '''近いアドレスが1回の読み出しにまとまり、値が正しく取り出せるかテスト。'''
+        tags = TagMap.from_dict({
+            'a': 'D11600:int16',
+            'b': 'D11604:uint32',
+            'c': 'D11700:uint8',
+            'd': 'R6653.2',
+            'e': 'R6653:uint8',
+            'f': {'address': 'D11602', 'type': 'int16', 'scale': 0.1, 'offset': 1},
+        }, max_gap=16)
+        plan = tags.plan()
+        self.assertEqual(plan, [('R6653', 1), ('D11600', 8), ('D11700', 1)])
+
+        blocks = [
+            b'\x05',
+            (-2).to_bytes(2, 'little', signed=True) + (100).to_bytes(2, 'little') + (70000).to_bytes(4, 'little'),
+            b'\xff']
+        values = tags.decode(blocks)
+        self.assertEqual(values['a'], -2)
+        self.assertEqual(values['b'], 70000)
+        self.assertEqual(values['c'], 255)
+        self.assertEqual(values['d'], 1)
+        self.assertEqual(values['e'], 5)
+        self.assertAlmostEqual(values['f'], 11.0)
+
+        # 最大バイト数を超える場合は分割
+        tags = TagMap.from_dict({'a': 'D0', 'b': 'D8'}, max_gap=16, max_length=4)
+        self.assertEqual(tags.plan(), [('D0', 1), ('D8', 1)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# coding: utf-8
+'''
+各モジュールで共通の小さな処理
+
+ファイルの保存(プロファイル、インデックス、アーカイブ)と、周期的な読み出し(Recorder、FleetCollector)で使う。
+'''
+import os
+import time
+
+
+def write_atomic(file_path, data):
+    '''ファイルを保存する。途中で止まっても書きかけのファイルが残らないよう、一時ファイル(.tmp)に書いてから置き換える。
+
+    Args:
+        file_path (str): 保存先のパス
+        data (bytes): ファイルの中身
+    '''
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+
+class Interval:
+    '''一定周期で処理を繰り返すための待ち合わせ。
+
+    周期は開始時刻からの累積で数えるため、処理時間の分だけ周期が延びることはない。
+    周期に間に合わない場合は、遅れを持ち越さずにすぐ次の処理を行う。
+    '''
+
+    def __init__(self, interval):
+        '''
+        Args:
+            interval (float): 周期(秒)
+        '''
+        self.__interval = interval
+        self.__next_time = time.time()
+
+    def wait(self, stop):
+        '''次の周期まで待つ。
+
+        Args:
+            stop (Event): 待っている途中でセットされたら、すぐに戻る
+        Return:
+            bool: stopがセットされていればTrue
+        '''
+        self.__next_time += self.__interval
+        wait = self.__next_time - time.time()
+        if wait < 0:
+            self.__next_time = time.time()
+            wait = 0
+        return stop.wait(wait)